@@ -0,0 +1,166 @@
+import copy
+import concurrent.futures
+import pandas as pd
+
+from piwik_ingest import COLUMN_TYPES
+from piwik_timing import recorder
+
+# Aggregated totals from the /api/analytics/v1/query endpoint ---------------------------------
+#
+# the "Today's Total..." panels only need grouped numbers, so Piwik PRO groups the rows and only the
+# summary rows are downloaded. every metric is a raw column with a transformation, matching what
+# the raw data path computes client side (e.g. pageviews = unique count of visitor_id per url).
+
+EVENT_TYPE_PAGEVIEW = 1
+EVENT_TYPE_SEARCH = 4
+EVENT_TYPE_ECOMMERCE = 9
+
+
+def event_type_condition(*event_types):
+    return {
+        "operator": "or",
+        "conditions": [
+            {
+                "column_id": "event_type",
+                "condition": {
+                    "operator": "eq",
+                    "value": event_type
+                }
+            } for event_type in event_types
+        ]
+    }
+
+
+# dimensions are column ids, metrics are (name, column_id, transformation_id) tuples
+def aggregate_query(website_id, dimensions, metrics, conditions=None, limit=100000):
+    columns = [{"column_id": d} for d in dimensions]
+    columns += [{"column_id": column_id, "transformation_id": transformation_id}
+                for _, column_id, transformation_id in metrics]
+
+    query = {
+        "relative_date": "today",
+        "website_id": website_id,
+        "columns": columns,
+        "filters": {
+            "operator": "and",
+            "conditions": copy.deepcopy(conditions or [])
+        },
+        "offset": 0,
+        "limit": limit,
+        "format": "json"
+    }
+    # biggest first, like the raw data tables
+    if dimensions:
+        query["order_by"] = [[len(dimensions), "desc"]]
+    return query
+
+
+# type of a metric: counts and sums of integer columns are whole numbers, like the raw data totals
+def metric_type(column, transformation):
+    if transformation == "unique_count" or COLUMN_TYPES.get(column, "").startswith("int"):
+        return "int64"
+    return "float64"
+
+
+# schema for piwik_ingest.build_frame: typed dimensions followed by numeric metrics
+def aggregate_schema(dimensions, metrics):
+    schema = [(d, COLUMN_TYPES.get(d, "text")) for d in dimensions]
+    schema += [(name, metric_type(column, transformation)) for name, column, transformation in metrics]
+    return schema
+
+
+# name: (dimensions, metrics, event types the rows are filtered on)
+TOTAL_QUERIES = {
+    "sessions": ([], [("sessions", "session_id", "unique_count"),
+                      ("orders", "session_total_ecommerce_conversions", "sum")], None),
+    "sources": (["source", "medium", "campaign_name"],
+                [("sessions", "session_id", "unique_count"),
+                 ("orders", "session_total_ecommerce_conversions", "sum")], None),
+    "revenue": ([], [("revenue", "revenue", "sum")],
+                (EVENT_TYPE_SEARCH, EVENT_TYPE_PAGEVIEW, EVENT_TYPE_ECOMMERCE)),
+    "pageviews": ([], [("pageviews", "visitor_id", "unique_count")], (EVENT_TYPE_PAGEVIEW,)),
+    "pageviews_table": (["event_url"], [("pageviews", "visitor_id", "unique_count")],
+                        (EVENT_TYPE_PAGEVIEW,)),
+    "searches": ([], [("unique_searches", "visitor_id", "unique_count")], (EVENT_TYPE_SEARCH,)),
+    "searches_table": (["search_keyword"], [("unique_searches", "visitor_id", "unique_count")],
+                       (EVENT_TYPE_SEARCH,)),
+}
+
+# which aggregated queries each dashboard section needs
+TOTAL_SECTIONS = {
+    "total_sessions": ["sessions", "sources", "revenue"],
+    "total_pageviews": ["pageviews", "pageviews_table"],
+    "total_searches": ["searches", "searches_table"],
+}
+
+
+# column each totals table is summed on when both paths are compared
+TABLE_VALUE_COLUMNS = {
+    "sources": "sessions",
+    "pageviews_table": "pageviews",
+    "searches_table": "unique_searches",
+}
+
+
+def conversion_rate(df_source):
+    df_source[r"% conversion rate"] = df_source["orders"] / df_source["sessions"] * 100
+    return df_source
+
+
+# fetch(query, url, schema) returns the typed response DataFrame, like piwik_query does.
+# returns a dict with the same keys as piwik_metrics.raw_totals, see totals_from_frames
+@recorder.timed("aggregation")
+def aggregate_totals(fetch, url, website_id, sections, max_workers=4):
+    names = [name for section in sections for name in TOTAL_SECTIONS[section]]
+
+    def run(name):
+        dimensions, metrics, event_types = TOTAL_QUERIES[name]
+        conditions = [event_type_condition(*event_types)] if event_types else None
+        query = aggregate_query(website_id, dimensions, metrics, conditions)
+        return fetch(query, url, schema=aggregate_schema(dimensions, metrics))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        frames = dict(zip(names, pool.map(run, names)))
+
+    return totals_from_frames(frames)
+
+
+def scalar(frame, column):
+    if frame.empty:
+        return 0
+    return frame[column].iloc[0]
+
+
+def totals_from_frames(frames):
+    totals = {}
+    if "sessions" in frames:
+        totals["sessions"] = int(scalar(frames["sessions"], "sessions"))
+        totals["orders"] = round(scalar(frames["sessions"], "orders"))
+        totals["sources"] = conversion_rate(frames["sources"])
+        totals["revenue"] = round(scalar(frames["revenue"], "revenue"), 2)
+    if "pageviews" in frames:
+        totals["pageviews"] = int(scalar(frames["pageviews"], "pageviews"))
+        totals["pageviews_table"] = frames["pageviews_table"].rename(columns={"event_url": "url"})
+    if "searches" in frames:
+        totals["searches"] = int(scalar(frames["searches"], "unique_searches"))
+        totals["searches_table"] = frames["searches_table"]
+    return totals
+
+
+# side by side check of both paths. tables are compared on their row count and column total
+def compare_totals(aggregated, raw):
+    rows = []
+    for name in aggregated:
+        if name not in raw:
+            continue
+        a, r = aggregated[name], raw[name]
+        if isinstance(a, pd.DataFrame):
+            value_column = TABLE_VALUE_COLUMNS[name]
+            rows.append((f"{name} rows", len(a), len(r)))
+            rows.append((f"{name} {value_column}", a[value_column].sum(), r[value_column].sum()))
+        else:
+            rows.append((name, a, r))
+
+    comparison = pd.DataFrame(rows, columns=["metric", "aggregated", "raw"])
+    comparison["difference"] = comparison["aggregated"] - comparison["raw"]
+    return comparison
@@ -0,0 +1,223 @@
+import os
+import json
+import copy
+import pandas as pd
+
+from piwik_ingest import FrameBuilder, response_rows, decode_json
+from piwik_timing import recorder
+from piwik_sites import valid_domain
+from piwik_http import http, endpoint_name, response_error, PiwikError, PiwikRateLimited  # noqa: F401
+
+# Piwik PRO raw data API helpers shared by the streamlit app and the data testing script
+
+# columns that the raw data API always returns before the requested columns
+SESSION_BASE_COLUMNS = ['session_id', 'visitor_id', 'timestamp']
+EVENT_BASE_COLUMNS = ['session_id', 'event_id', 'visitor_id', 'timestamp']
+
+# PIWIK_PRO_BASE_URL points every script at another server, e.g. piwik_fake_server.py
+def api_urls(piwik_domain, base_url=None):
+    # the domain is part of the url, it must not be able to point anywhere else
+    if not valid_domain(piwik_domain):
+        raise ValueError(f"{piwik_domain!r} is not a Piwik PRO domain")
+    base_url = base_url or os.environ.get("PIWIK_PRO_BASE_URL") or f'https://{piwik_domain}.piwik.pro'
+    return {
+        "token": f'{base_url}/auth/token',
+        "query": f'{base_url}/api/analytics/v1/query',
+        "sessions": f'{base_url}/api/analytics/v1/sessions/',
+        "events": f'{base_url}/api/analytics/v1/events/',
+    }
+
+
+def raw_session_query(website_id):
+    return {
+        "relative_date": "today",
+        "website_id": website_id,
+        "columns": [
+            {
+                "column_id": "source"
+            },
+            {
+                "column_id": "medium"
+            },
+            {
+                "column_id": "campaign_name"
+            },
+            {
+                "column_id": "session_total_ecommerce_conversions"
+            },
+
+        ],
+        "filters": {
+            "operator": "and",
+            "conditions": []
+        },
+        "offset": 0,
+        "limit": 100000,
+        "format": "json"
+    }
+
+
+def raw_event_query(website_id):
+    return {
+        "relative_date": "today",
+        "website_id": website_id,
+        "columns": [
+            {
+                "column_id": "event_type"
+            },
+            {
+                "column_id": "event_url"
+            },
+            {
+                "column_id": "search_keyword"
+            },
+            {
+                "column_id": "revenue"
+            },
+            {
+                "column_id": "order_id"
+            },
+
+        ],
+        "order_by": [
+            [
+                4,
+                "desc"
+            ]
+        ],
+        "filters": {
+            "operator": "and",
+            "conditions": [
+                {
+                    "operator": "or",
+                    "conditions": [
+                        {
+                            "column_id": "event_type",
+                            "condition": {
+                                "operator": "eq",
+                                "value": 4  # Search
+                            }
+                        },
+                        {
+                            "column_id": "event_type",
+                            "condition": {
+                                "operator": "eq",
+                                "value": 1  # Page View
+                            }
+                        },
+                        {
+                            "column_id": "event_type",
+                            "condition": {
+                                "operator": "eq",
+                                "value": 9  # Ecommerce Conversion
+                            }
+                        }
+                    ]
+                }
+            ]
+        },
+        "offset": 0,
+        "limit": 100000,
+        "format": "json",
+        "column_format": "name"
+    }
+
+
+# authentication token on Piwik PRO API ---------------------------------
+
+
+def request_token(url, id, secret):
+    creds = {
+        "grant_type": "client_credentials",
+        "client_id": id,
+        "client_secret": secret
+    }
+    response = http.post(url, data=creds, headers={
+                             'Accept': 'application/json'}, json={"key": "value"})
+    if response.status_code != 200:
+        raise PiwikError(f"Piwik PRO refused the client credentials: {response_error(response)}",
+                         response.status_code)
+
+    token_data = response.json()
+
+    return token_data
+
+
+# tokens is a piwik_auth.TokenManager. a 401 means the token expired early, it is renewed and the
+# query sent once more. with a schema (see piwik_ingest.query_schema) the rows are built into typed
+# columns while the response downloads, see piwik_ingest.response_rows
+def piwik_query(query, url_query, tokens, schema=None):
+    endpoint = endpoint_name(url_query)
+
+    headers = tokens.headers()
+    with recorder.stage("http", endpoint=endpoint):
+        piwik_response = http.post(
+            url_query, headers=headers, data=json.dumps(query), stream=True)
+
+        if piwik_response.status_code == 401:
+            piwik_response.close()
+            tokens.invalidate(headers)
+            piwik_response = http.post(
+                url_query, headers=tokens.headers(), data=json.dumps(query), stream=True)
+
+    with piwik_response:
+        if piwik_response.status_code == 429:
+            retry_after = piwik_response.headers.get("Retry-After", "")
+            raise PiwikRateLimited(endpoint, int(retry_after) if retry_after.isdigit() else None)
+        if piwik_response.status_code != 200:
+            raise PiwikError(response_error(piwik_response), piwik_response.status_code)
+
+        # the body download is part of the decode stage, bytes are as sent (gzipped)
+        with recorder.stage("decode", endpoint=endpoint) as stage:
+            if schema is not None:
+                builder = FrameBuilder(schema)
+                for rows in response_rows(piwik_response):
+                    builder.add(rows)
+                stage.rows = builder.rows
+            else:
+                rows = decode_json(piwik_response.content)['data']
+                stage.rows = len(rows)
+            stage.bytes = piwik_response.raw.tell()
+
+    if schema is not None:
+        with recorder.stage("build frame", endpoint=endpoint) as stage:
+            piwik_data = builder.frame()
+            stage.rows = len(piwik_data)
+            stage.bytes = int(piwik_data.memory_usage(deep=True).sum())
+    else:
+        piwik_data = pd.DataFrame(rows)
+    return piwik_data
+
+
+# copy of a raw query restricted to rows with timestamp in [since, until)
+def timestamp_filter(query, since=None, until=None):
+    query = copy.deepcopy(query)
+
+    conditions = []
+    if since is not None:
+        conditions.append({
+            "column_id": "timestamp",
+            "condition": {
+                "operator": "gte",
+                "value": since.strftime("%Y-%m-%dT%H:%M:%S")
+            }
+        })
+    if until is not None:
+        conditions.append({
+            "column_id": "timestamp",
+            "condition": {
+                "operator": "lt",
+                "value": until.strftime("%Y-%m-%dT%H:%M:%S")
+            }
+        })
+
+    query["filters"]["conditions"].extend(conditions)
+    return query
+
+
+# copy of a "today" query asking for the rows of a past day instead
+def past_day(query, day):
+    query = copy.deepcopy(query)
+    query.pop("relative_date", None)
+    query["date_from"] = query["date_to"] = day.isoformat()
+    return query
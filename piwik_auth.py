@@ -0,0 +1,64 @@
+import time
+import hashlib
+import threading
+
+from piwik_api import api_urls, request_token
+from piwik_timing import recorder
+
+# Token manager for the Piwik PRO API ---------------------------------
+#
+# tokens are kept per domain and client id for the whole process, so streamlit reruns and other
+# viewers of the same client reuse them instead of asking /auth/token on every page load. a token
+# is renewed refresh_margin seconds before it expires. the lock makes the renewal single-flight:
+# concurrent callers wait for the one request in progress instead of firing their own.
+
+
+class TokenManager:
+
+    def __init__(self, token_url, client_id, client_secret, refresh_margin=60):
+        self.token_url = token_url
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_margin = refresh_margin
+
+        self.lock = threading.Lock()
+        self.token = None
+        self.expires_at = 0
+
+    def refresh(self):
+        with recorder.stage("token"):
+            token_data = request_token(self.token_url, self.client_id, self.client_secret)
+
+        self.token = token_data['access_token']
+        # Piwik PRO tokens last 30 minutes when expires_in is not sent
+        self.expires_at = time.monotonic() + int(token_data.get('expires_in', 1800))
+        print("token generated")
+
+    def headers(self):
+        with self.lock:
+            if self.token is None or time.monotonic() >= self.expires_at - self.refresh_margin:
+                self.refresh()
+
+            return {"Authorization": "Bearer " + self.token, "Accept-Encoding": "gzip"}
+
+    # drops the token the given headers were built with, e.g. after a 401 response
+    def invalidate(self, headers):
+        with self.lock:
+            if self.token is not None and headers.get("Authorization") == "Bearer " + self.token:
+                self.token = None
+
+
+token_managers = {}
+token_managers_lock = threading.Lock()
+
+
+# the secret is part of the key, so a wrong secret never gets a token issued for the right one
+def get_token_manager(piwik_domain, client_id, client_secret):
+    secret_hash = hashlib.sha256(client_secret.encode()).hexdigest()
+    key = (piwik_domain, client_id, secret_hash)
+
+    with token_managers_lock:
+        if key not in token_managers:
+            token_managers[key] = TokenManager(
+                api_urls(piwik_domain)["token"], client_id, client_secret)
+        return token_managers[key]
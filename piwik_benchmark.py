@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import requests
+import pandas as pd
+
+from piwik_api import (api_urls, request_token, raw_session_query, raw_event_query,
+                       SESSION_BASE_COLUMNS, EVENT_BASE_COLUMNS, piwik_query)
+from piwik_auth import TokenManager
+from piwik_ingest import query_schema, build_frame, bytes_per_row
+from piwik_incremental import IncrementalQuery
+from piwik_aggregate import aggregate_totals, compare_totals, TOTAL_SECTIONS
+from piwik_metrics import raw_totals
+from piwik_window import SessionBuckets, EventBuckets
+from piwik_store import day_store, STORE_DIRECTORY
+from piwik_fake_server import start_server
+
+# Benchmark suite against the local Piwik PRO stand-in ---------------------------------
+#
+# for every day size a fake server is started (see piwik_fake_server) and each stage of a refresh is
+# timed on its own: token, HTTP fetch, JSON decode, typed frame build, every aggregation, the
+# incremental refresh and, with --render, a full run of the streamlit app. results are saved as
+# JSON, --baseline compares them with an earlier file so regressions show up between versions.
+#
+#   python piwik_benchmark.py --rows 10000 100000 1000000 --baseline benchmarks/previous.json
+
+BENCHMARK_DIRECTORY = "benchmarks"
+
+
+def timed(stage, results, function, repeat=1, rows=None, nbytes=None):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = function()
+        secs = time.perf_counter() - start
+        best = secs if best is None else min(best, secs)
+
+    results[stage] = {"secs": round(best, 6)}
+    if rows is not None:
+        results[stage]["rows"] = rows(value) if callable(rows) else rows
+    if nbytes is not None:
+        results[stage]["bytes"] = nbytes(value) if callable(nbytes) else nbytes
+    print(f"  {stage:<32} {best:9.4f} secs")
+    return value
+
+
+# peak traced allocation of one more run of a timed stage
+def trace_peak(stage, results, function):
+    tracemalloc.start()
+    try:
+        function()
+        results[stage]["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    print(f"  {stage + ' peak memory':<32} {results[stage]['peak_memory_bytes'] / 1e6:9.1f} MB")
+
+
+# the whole day in one request, so fetch / decode / build are measured without partitioning
+def full_day(query, rows):
+    return dict(query, limit=rows)
+
+
+def benchmark_scale(rows, seed, latency_ms, repeat, render):
+    server = start_server(rows, seed=seed, latency_ms=latency_ms)
+    urls = api_urls("benchmark", server.base_url)
+    results = {}
+    print(f"{rows} events ({server.base_url})")
+
+    try:
+        timed("token", results, lambda: request_token(urls["token"], "benchmark", "benchmark"), repeat)
+        tokens = TokenManager(urls["token"], "benchmark", "benchmark")
+
+        frames = {}
+        for name, url, query, base_columns in [
+                ("sessions", urls["sessions"], raw_session_query("1"), SESSION_BASE_COLUMNS),
+                ("events", urls["events"], raw_event_query("1"), EVENT_BASE_COLUMNS)]:
+            query = full_day(query, rows)
+            schema = query_schema(base_columns, query)
+
+            response = timed(f"{name} fetch", results, lambda: requests.post(
+                url, headers=tokens.headers(), data=json.dumps(query)), repeat,
+                nbytes=lambda r: len(r.content))
+            data = timed(f"{name} decode", results, lambda: json.loads(response.content)["data"],
+                         repeat, rows=len)
+            frame = timed(f"{name} build frame", results, lambda: build_frame(data, schema),
+                          repeat, rows=len, nbytes=lambda f: int(f.memory_usage(deep=True).sum()))
+            results[f"{name} build frame"]["bytes_per_row"] = round(bytes_per_row(frame), 1)
+            trace_peak(f"{name} decode", results, lambda: build_frame(json.loads(response.content)["data"], schema))
+            frames[name] = frame
+
+            # the same rows as the app gets them: decoded and typed while they download
+            timed(f"{name} streamed query", results,
+                  lambda: piwik_query(query, url, tokens, schema), repeat, rows=len)
+            trace_peak(f"{name} streamed query", results, lambda: piwik_query(query, url, tokens, schema))
+
+        for section in TOTAL_SECTIONS:
+            timed(f"raw totals {section}", results,
+                  lambda: raw_totals(frames["sessions"], frames["events"], [section]), repeat)
+        timed("raw totals all sections", results,
+              lambda: raw_totals(frames["sessions"], frames["events"], list(TOTAL_SECTIONS)), repeat)
+
+        now = datetime.datetime.now()
+        session_buckets = timed("session buckets add", results,
+                                lambda: add_buckets(SessionBuckets(), frames["sessions"]), repeat)
+        event_buckets = timed("event buckets add", results,
+                              lambda: add_buckets(EventBuckets(), frames["events"]), repeat)
+        event_sketches = timed("event buckets add (hll)", results,
+                               lambda: add_buckets(EventBuckets(distinct="hll"), frames["events"]), repeat)
+        timed("session window 30 mins", results, lambda: session_buckets.window(now, 30), repeat)
+        timed("event window 30 mins", results, lambda: event_buckets.window(now, 30), repeat)
+        timed("event window 30 mins (hll)", results, lambda: event_sketches.window(now, 30), repeat)
+
+        def fetch(query, url_query, schema=None):
+            return piwik_query(query, url_query, tokens, schema)
+
+        aggregated = timed("aggregated totals", results,
+                           lambda: aggregate_totals(fetch, urls["query"], "1", list(TOTAL_SECTIONS)), repeat)
+
+        # the totals computed from the raw rows must match the ones Piwik PRO aggregates
+        comparison = compare_totals(aggregated, raw_totals(frames["sessions"], frames["events"], list(TOTAL_SECTIONS)))
+        mismatches = comparison[comparison["difference"].abs() > 0.01]
+        results["totals parity"] = {"metrics": len(comparison), "mismatches": len(mismatches)}
+        print(f"  {'totals parity':<32} {len(mismatches):9d} mismatches")
+        if len(mismatches):
+            print(mismatches.to_string(index=False))
+
+        # the refresh the dashboard runs: the whole day in time slices, then only the new rows
+        events = IncrementalQuery(raw_event_query("1"), urls["events"], EVENT_BASE_COLUMNS,
+                                  ["session_id", "event_id"])
+        timed("incremental first refresh", results, lambda: events.refresh(fetch), rows=len)
+        timed("incremental next refresh", results, lambda: events.refresh(fetch),
+              rows=lambda _: len(events.last_delta))
+
+        if render:
+            timed("render app", results, lambda: render_app(server.base_url), rows=None)
+
+        results["api calls"] = dict(server.calls)
+    finally:
+        server.shutdown()
+
+    return results
+
+
+def add_buckets(buckets, frame):
+    buckets.add(frame)
+    return buckets
+
+
+# one run of the dashboard with every panel, through streamlit's app testing harness.
+# each run gets its own domain and an empty day store, nothing cached by earlier runs is reused
+def render_app(base_url):
+    from streamlit.testing.v1 import AppTest
+
+    os.environ["PIWIK_PRO_BASE_URL"] = base_url
+    piwik_domain = f"benchmark-{time.time_ns()}"
+
+    with tempfile.TemporaryDirectory() as directory:
+        day_store.directory = directory
+        try:
+            app = AppTest.from_file("piwikpro_realtime_streamlit.py", default_timeout=600)
+            app.run()
+            for name, value in zip(["Piwik Domain", "Website id", "Client ID", "Client Secret"],
+                                   [piwik_domain, "1", "benchmark", "benchmark"]):
+                next(t for t in app.sidebar.text_input if t.label.startswith(name)).set_value(value)
+            for checkbox in app.sidebar.checkbox:
+                checkbox.check()
+            app.run()
+        finally:
+            day_store.directory = STORE_DIRECTORY
+
+    if app.exception or app.error:
+        raise RuntimeError((app.exception or app.error)[0].value)
+    return app
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    print("\nchange against the baseline (secs, >1 is slower):")
+    for rows, stages in results["scales"].items():
+        previous = baseline.get("scales", {}).get(rows, {})
+        for stage, result in stages.items():
+            if "secs" not in result or "secs" not in previous.get(stage, {}):
+                continue
+            ratio = result["secs"] / max(previous[stage]["secs"], 1e-9)
+            flag = "  <-- slower" if ratio > 1.2 else ""
+            print(f"  {rows:>8} {stage:<32} {ratio:6.2f}x{flag}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the dashboard's refresh stages")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="events per generated day, one run per size")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, the fastest is kept")
+    parser.add_argument("--render", action="store_true", help="also time a run of the streamlit app")
+    parser.add_argument("--output", help="results file, by default a new one in benchmarks/")
+    parser.add_argument("--baseline", help="earlier results file to compare with")
+    args = parser.parse_args()
+
+    results = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "settings": {"seed": args.seed, "latency_ms": args.latency_ms, "repeat": args.repeat},
+        "scales": {},
+    }
+    for rows in args.rows:
+        results["scales"][str(rows)] = benchmark_scale(
+            rows, args.seed, args.latency_ms, args.repeat, args.render)
+
+    output = args.output or os.path.join(
+        BENCHMARK_DIRECTORY, f"benchmark-{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nresults saved to {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
@@ -0,0 +1,115 @@
+import json
+import time
+import datetime
+import threading
+import concurrent.futures
+
+# Process wide cache of Piwik PRO polls ---------------------------------
+#
+# every viewer of the same website asks for the same queries. results are cached per
+# (domain, client_id, website_id, normalized query) and handed to every session as the same
+# DataFrame, which callers must treat as read only. a request for a key that is already being
+# fetched waits for that fetch instead of starting its own (coalesced).
+# when a load fails, the key's last good result is handed out instead and the key is marked stale
+# since that result was loaded, until a load succeeds again.
+
+
+def cache_key(piwik_domain, client_id, website_id, query):
+    return (piwik_domain, client_id, website_id, json.dumps(query, sort_keys=True))
+
+
+class PollCache:
+
+    def __init__(self, idle_ttl=3600):
+        # entries not used for idle_ttl seconds are dropped
+        self.idle_ttl = idle_ttl
+
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        # key: (result, wall clock time it was loaded)
+        self.last_good = {}
+        # key: (time of the result served instead, error of the failed load)
+        self.stale = {}
+
+    def prune(self, now):
+        for key, entry in list(self.entries.items()):
+            if now - entry["used"] > self.idle_ttl and entry["future"].done():
+                del self.entries[key]
+                self.last_good.pop(key, None)
+                self.stale.pop(key, None)
+
+    # returns load()'s result for key, reusing one that is younger than max_age secs
+    def get(self, key, load, max_age):
+        now = time.monotonic()
+
+        with self.lock:
+            self.prune(now)
+            entry = self.entries.get(key)
+
+            if entry is not None and not entry["future"].done():
+                self.coalesced += 1
+                owner = False
+            elif (entry is not None and entry["future"].exception() is None
+                    and now - entry["loaded"] < max_age):
+                self.hits += 1
+                owner = False
+            else:
+                self.misses += 1
+                entry = {"future": concurrent.futures.Future(), "loaded": now, "used": now}
+                self.entries[key] = entry
+                owner = True
+
+            entry["used"] = now
+
+        # the first caller runs the load, everyone else waits for its result
+        if owner:
+            try:
+                result = load()
+            except Exception as e:
+                with self.lock:
+                    good = self.last_good.get(key)
+                    if good is not None:
+                        self.stale[key] = (good[1], e)
+                if good is None:
+                    entry["future"].set_exception(e)
+                else:
+                    entry["future"].set_result(good[0])
+            else:
+                with self.lock:
+                    self.last_good[key] = (result, datetime.datetime.now())
+                    self.stale.pop(key, None)
+                entry["future"].set_result(result)
+            entry["loaded"] = time.monotonic()
+
+        return entry["future"].result()
+
+    # drops the given keys' finished entries and last good results
+    def forget(self, keys):
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is not None and entry["future"].done():
+                    del self.entries[key]
+                self.last_good.pop(key, None)
+                self.stale.pop(key, None)
+
+    # (loaded at, error) when key is served its last good result because loads fail, else None
+    def stale_since(self, key):
+        with self.lock:
+            return self.stale.get(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "stale": len(self.stale),
+            }
+
+
+poll_cache = PollCache()
@@ -0,0 +1,240 @@
+import os
+import json
+import signal
+import sqlite3
+import argparse
+import datetime
+import threading
+import traceback
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+from piwik_api import (api_urls, piwik_query, raw_session_query, raw_event_query,
+                       SESSION_BASE_COLUMNS, EVENT_BASE_COLUMNS)
+from piwik_auth import get_token_manager
+from piwik_incremental import IncrementalQuery, SESSION_OVERLAP_MINUTES
+from piwik_aggregate import aggregate_totals, TOTAL_SECTIONS
+from piwik_metrics import raw_totals
+from piwik_window import SessionBuckets, EventBuckets
+from piwik_store import day_store
+from piwik_timing import recorder
+from piwik_poll import AdaptivePoll, PROBE_METRICS
+from piwik_snapshots import SnapshotStore
+from piwik_sites import valid_domain, valid_website_id
+
+# Headless collector ---------------------------------
+#
+# polls one website on a fixed schedule without a browser attached and publishes the same live
+# and daily numbers the dashboard shows to a local sink, one snapshot per poll. dashboards and
+# alerting read the snapshots instead of each of them querying Piwik PRO.
+# tokens are renewed before they expire, a failed poll is logged and retried on the next tick.
+# today's totals come from the aggregated query and only the last hour is kept as raw rows for the
+# live windows, unless --raw-totals asks for the whole day of raw rows.
+# with --sink arrow the collector is the dashboard's fetch worker: it writes Arrow snapshots the
+# dashboard memory-maps instead of polling Piwik PRO itself (see piwik_snapshots).
+#
+#   PIWIK_CLIENT_SECRET=... python piwik_collector.py --domain mydomain --website-id ... \
+#       --client-id ... --sink sqlite --output collector.sqlite
+
+LIVE_WINDOW_MINUTES = 60
+
+
+def jsonable(value):
+    if isinstance(value, pd.DataFrame):
+        return [{k: jsonable(v) for k, v in row.items()} for row in value.to_dict("records")]
+    if isinstance(value, dict):
+        return {k: jsonable(v) for k, v in value.items()}
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+# appends one JSON object per line, readers tail the file
+class JsonLinesSink:
+
+    def __init__(self, path):
+        self.path = path
+
+    def publish(self, snapshot):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(jsonable(snapshot)) + "\n")
+
+
+# keeps every snapshot and the latest one per website, readers query the latest table
+class SQLiteSink:
+
+    def __init__(self, path):
+        self.path = path
+        con = sqlite3.connect(self.path)
+        with con:
+            con.execute("CREATE TABLE IF NOT EXISTS snapshots (time TEXT, website_id TEXT, snapshot TEXT)")
+            con.execute("CREATE TABLE IF NOT EXISTS latest (website_id TEXT PRIMARY KEY, time TEXT, snapshot TEXT)")
+        con.close()
+
+    def publish(self, snapshot):
+        row = (snapshot["time"], snapshot["website_id"], json.dumps(jsonable(snapshot)))
+        con = sqlite3.connect(self.path)
+        try:
+            with con:
+                con.execute("INSERT INTO snapshots (time, website_id, snapshot) VALUES (?, ?, ?)", row)
+                con.execute("INSERT OR REPLACE INTO latest (time, website_id, snapshot) VALUES (?, ?, ?)", row)
+        finally:
+            con.close()
+
+
+# a versioned directory of Arrow files per website under path, tables stay columnar
+class ArrowSink:
+
+    def __init__(self, path):
+        self.store = SnapshotStore(path)
+
+    def publish(self, snapshot):
+        values = {k: v for k, v in snapshot.items() if k not in ("time", "piwik_domain", "website_id")}
+        self.store.publish(snapshot["piwik_domain"], snapshot["website_id"], snapshot["time"], values)
+
+
+SINKS = {"jsonl": JsonLinesSink, "sqlite": SQLiteSink, "arrow": ArrowSink}
+
+
+class Collector:
+
+    def __init__(self, piwik_domain, website_id, client_id, client_secret, live_minutes=(30,),
+                 raw_totals=False):
+        self.piwik_domain = piwik_domain
+        self.website_id = website_id
+        self.live_minutes = live_minutes
+        self.raw_totals = raw_totals
+
+        urls = api_urls(piwik_domain)
+        self.query_url = urls["query"]
+        self.tokens = get_token_manager(piwik_domain, client_id, client_secret)
+
+        # the whole day is only downloaded when the totals are computed from it. a probe skips the
+        # download when nothing changed since the last poll. like in the app, a live window query has
+        # its own day store tables, its rows must not mark the whole day tables as covered
+        window = None if raw_totals else LIVE_WINDOW_MINUTES
+        suffix = "" if window is None else " live"
+        session_query = raw_session_query(website_id)
+        self.session_query = IncrementalQuery(
+            session_query, urls["sessions"], SESSION_BASE_COLUMNS, ["session_id"],
+            overlap_minutes=SESSION_OVERLAP_MINUTES, window_minutes=window, store=day_store, store_key=(piwik_domain, website_id, f"sessions{suffix}"),
+            buckets=SessionBuckets(LIVE_WINDOW_MINUTES),
+            poll=AdaptivePoll(session_query, self.query_url, PROBE_METRICS["sessions"]))
+        event_query = raw_event_query(website_id)
+        self.event_query = IncrementalQuery(
+            event_query, urls["events"], EVENT_BASE_COLUMNS, ["session_id", "event_id"],
+            window_minutes=window, store=day_store, store_key=(piwik_domain, website_id, f"events{suffix}"),
+            buckets=EventBuckets(LIVE_WINDOW_MINUTES),
+            poll=AdaptivePoll(event_query, self.query_url, PROBE_METRICS["events"]))
+
+    def fetch(self, query, url_query, schema=None):
+        return piwik_query(query, url_query, self.tokens, schema)
+
+    def collect(self, now=None):
+        now = now or datetime.datetime.now()
+
+        with recorder.stage("collect", website=self.website_id):
+            session_data = self.session_query.refresh(self.fetch, now)
+            event_data = self.event_query.refresh(self.fetch, now)
+
+            live = {}
+            for minutes in self.live_minutes:
+                live[f"{minutes} mins"] = {
+                    **self.session_query.buckets.window(now, minutes),
+                    **self.event_query.buckets.window(now, minutes),
+                }
+
+            if self.raw_totals:
+                totals = raw_totals(session_data, event_data, list(TOTAL_SECTIONS))
+            else:
+                totals = aggregate_totals(self.fetch, self.query_url, self.website_id, list(TOTAL_SECTIONS))
+
+        return {
+            "time": now.isoformat(timespec="seconds"),
+            "piwik_domain": self.piwik_domain,
+            "website_id": self.website_id,
+            "live": live,
+            "totals": totals,
+            "truncated": len(self.session_query.truncated) + len(self.event_query.truncated),
+        }
+
+
+def run(collector, sink, interval, stop):
+    next_poll = datetime.datetime.now()
+
+    while not stop.is_set():
+        try:
+            snapshot = collector.collect()
+            sink.publish(snapshot)
+            print(f'{snapshot["time"]} published: {snapshot["totals"].get("sessions")} sessions today, '
+                  f'{snapshot["truncated"]} truncated slices', flush=True)
+        except Exception as e:
+            print(f"poll failed: {e}", flush=True)
+            traceback.print_exc()
+
+        # fixed schedule, a slow poll does not push the next ones back
+        next_poll += datetime.timedelta(seconds=interval)
+        now = datetime.datetime.now()
+        if next_poll < now:
+            next_poll = now
+        stop.wait((next_poll - now).total_seconds())
+
+
+# one website's polling, in its own process when several websites are collected
+def work(args, website_id, client_secret):
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    collector = Collector(args.domain, website_id, args.client_id, client_secret,
+                          args.live_minutes, args.raw_totals)
+    run(collector, SINKS[args.sink](args.output), args.interval, stop)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Poll Piwik PRO and publish the dashboard numbers")
+    parser.add_argument("--domain", required=True, help="Piwik domain (from domain.piwik.pro)")
+    parser.add_argument("--website-id", required=True, nargs="+",
+                        help="several ids are polled by one worker process each")
+    parser.add_argument("--client-id", required=True)
+    parser.add_argument("--interval", type=int, default=60, help="secs between polls")
+    parser.add_argument("--live-minutes", type=int, nargs="+", default=[30],
+                        help=f"live windows to publish, up to {LIVE_WINDOW_MINUTES}")
+    parser.add_argument("--raw-totals", action="store_true",
+                        help="compute today's totals from the day's raw rows instead of the aggregated query")
+    parser.add_argument("--sink", choices=SINKS, default="jsonl")
+    parser.add_argument("--output", default="collector.jsonl",
+                        help="sink file, for --sink arrow the snapshot directory (the dashboard's PIWIK_SNAPSHOT_DIR)")
+    args = parser.parse_args()
+
+    # the secret is not passed on the command line, where other users of the machine could see it
+    client_secret = os.environ.get("PIWIK_CLIENT_SECRET")
+    if not client_secret:
+        parser.error("set the client secret in the PIWIK_CLIENT_SECRET environment variable")
+    if max(args.live_minutes) > LIVE_WINDOW_MINUTES:
+        parser.error(f"live windows can be at most {LIVE_WINDOW_MINUTES} minutes")
+    # both end up in request urls and store file paths
+    if not valid_domain(args.domain):
+        parser.error(f"{args.domain!r} is not a Piwik PRO domain, use the name before .piwik.pro")
+    for website_id in args.website_id:
+        if not valid_website_id(website_id):
+            parser.error(f"{website_id!r} is not a website id")
+
+    if len(args.website_id) == 1:
+        work(args, args.website_id[0], client_secret)
+    else:
+        # the fetching and aggregation of every website runs on its own core
+        workers = [multiprocessing.Process(target=work, args=(args, website_id, client_secret),
+                                           name=f"collector {website_id}")
+                   for website_id in args.website_id]
+        for worker in workers:
+            worker.start()
+        signal.signal(signal.SIGTERM, lambda *_: [worker.terminate() for worker in workers])
+        # ctrl+c reaches every worker, they stop on their own
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for worker in workers:
+            worker.join()
+    print("collector stopped")
@@ -0,0 +1,281 @@
+import gzip
+import json
+import time
+import random
+import argparse
+import datetime
+import threading
+import collections
+import urllib.parse
+import numpy as np
+import pandas as pd
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Local stand-in for the Piwik PRO API ---------------------------------
+#
+# serves /auth/token, the raw /api/analytics/v1/sessions/ and /events/ endpoints and the aggregated
+# /api/analytics/v1/query endpoint for one generated day of traffic, with the row and column layout
+# the dashboard reads (including the [id, name] event_type pairs). the day is generated from a seed
+# so benchmark runs are comparable, and every response can be delayed to mimic the network. a query
+# with a date_from in the past gets a whole day generated from the seed and how many days back it is.
+#
+#   python piwik_fake_server.py --rows 100000 --latency-ms 150
+#   PIWIK_PRO_BASE_URL=http://127.0.0.1:8765 streamlit run piwikpro_realtime_streamlit.py
+
+EVENTS_PER_SESSION = 3
+
+SOURCES = [("google", "organic", "(not set)"), ("google", "cpc", "brand"), ("bing", "cpc", "brand"),
+           ("facebook", "social", "spring_sale"), ("newsletter", "email", "weekly"),
+           ("(direct)", "(none)", "(not set)")]
+EVENT_TYPES = {1: "page_view", 4: "search", 9: "ecommerce_conversion"}
+
+
+class FakeDay:
+
+    # rows is the number of events of the day, a third of that are sessions
+    def __init__(self, rows, seed=0, now=None):
+        rng = np.random.default_rng(seed)
+        now = now or datetime.datetime.now()
+        self.rows = rows
+        self.seed = seed
+        self.date = now.date()
+        start = np.datetime64(datetime.datetime.combine(now.date(), datetime.time()), "s")
+        end = np.datetime64(now.replace(microsecond=0), "s")
+        span = max(int((end - start) / np.timedelta64(1, "s")), 1)
+
+        n_sessions = max(rows // EVENTS_PER_SESSION, 1)
+        self.session_ts = start + np.sort(rng.integers(0, span, n_sessions)).astype("timedelta64[s]")
+        self.session_visitor = rng.integers(0, max(n_sessions // 2, 1), n_sessions)
+        self.session_source = rng.choice(len(SOURCES), n_sessions, p=[.35, .2, .1, .15, .1, .1])
+        self.session_orders = (rng.random(n_sessions) < 0.03).astype(np.int32)
+
+        # events follow their session by up to 10 minutes, never after "now"
+        session = rng.integers(0, n_sessions, rows)
+        ts = np.minimum(self.session_ts[session] + rng.integers(0, 600, rows).astype("timedelta64[s]"), end)
+        order = np.argsort(ts, kind="stable")
+        self.event_session = session[order]
+        self.event_ts = ts[order]
+        self.event_number = np.arange(rows)
+        self.event_type = rng.choice([1, 4, 9], rows, p=[.8, .15, .05])
+        # a few popular urls and keywords, a long tail of rare ones
+        self.event_url = np.minimum(rng.zipf(1.3, rows), 50000)
+        self.event_keyword = np.minimum(rng.zipf(1.5, rows), 5000)
+        self.event_revenue = np.where(self.event_type == 9, rng.integers(5, 200, rows), 0).astype(np.float64)
+
+    # column_id: function of the row indices returning the column values
+    def session_columns(self):
+        return {
+            "session_id": lambda i: [f"s{x}" for x in i],
+            "visitor_id": lambda i: [f"v{x}" for x in self.session_visitor[i]],
+            "timestamp": lambda i: np.datetime_as_string(self.session_ts[i]).tolist(),
+            "source": lambda i: [SOURCES[x][0] for x in self.session_source[i]],
+            "medium": lambda i: [SOURCES[x][1] for x in self.session_source[i]],
+            "campaign_name": lambda i: [SOURCES[x][2] for x in self.session_source[i]],
+            "session_total_ecommerce_conversions": lambda i: self.session_orders[i].tolist(),
+        }
+
+    def event_columns(self):
+        sessions = self.event_session
+        return {
+            "session_id": lambda i: [f"s{x}" for x in sessions[i]],
+            "event_id": lambda i: [f"e{x}" for x in self.event_number[i]],
+            "visitor_id": lambda i: [f"v{x}" for x in self.session_visitor[sessions[i]]],
+            "timestamp": lambda i: np.datetime_as_string(self.event_ts[i]).tolist(),
+            "event_type": lambda i: [[int(x), EVENT_TYPES[x]] for x in self.event_type[i]],
+            "event_url": lambda i: [f"https://shop.example/p/{x}" for x in self.event_url[i]],
+            "search_keyword": lambda i: [f"keyword {x}" if t == 4 else None
+                                         for x, t in zip(self.event_keyword[i], self.event_type[i])],
+            "revenue": lambda i: self.event_revenue[i].tolist(),
+            "order_id": lambda i: [f"o{x}" if t == 9 else None
+                                   for x, t in zip(self.event_number[i], self.event_type[i])],
+        }
+
+
+def query_conditions(query):
+    since = until = event_types = None
+    for condition in query.get("filters", {}).get("conditions", []):
+        if condition.get("column_id") == "timestamp":
+            value = np.datetime64(condition["condition"]["value"], "s")
+            if condition["condition"]["operator"] == "gte":
+                since = value
+            else:
+                until = value
+        elif condition.get("operator") == "or":
+            event_types = [c["condition"]["value"] for c in condition["conditions"]]
+    return since, until, event_types
+
+
+# indices of the rows a query selects, timestamps are sorted so the range is two binary searches
+def selected_rows(timestamps, types, query):
+    since, until, event_types = query_conditions(query)
+    first = 0 if since is None else np.searchsorted(timestamps, since, side="left")
+    last = len(timestamps) if until is None else np.searchsorted(timestamps, until, side="left")
+    rows = np.arange(first, last)
+    if event_types is not None and types is not None:
+        rows = rows[np.isin(types[rows], event_types)]
+    return rows
+
+
+def raw_rows(day, query, sessions):
+    if sessions:
+        columns, base = day.session_columns(), ["session_id", "visitor_id", "timestamp"]
+        rows = selected_rows(day.session_ts, None, query)
+    else:
+        columns, base = day.event_columns(), ["session_id", "event_id", "visitor_id", "timestamp"]
+        rows = selected_rows(day.event_ts, day.event_type, query)
+
+    offset = query.get("offset", 0)
+    rows = rows[offset:offset + query.get("limit", 100000)]
+
+    names = base + [c["column_id"] for c in query["columns"]]
+    return [list(r) for r in zip(*(columns[n](rows) for n in names))] if len(rows) else []
+
+
+def aggregated_rows(day, query):
+    ids = [c["column_id"] for c in query["columns"]]
+    session_only = {"source", "medium", "campaign_name", "session_total_ecommerce_conversions"}
+    _, _, event_types = query_conditions(query)
+
+    if event_types is None and set(ids) - {"session_id", "visitor_id"} <= session_only:
+        columns, rows = day.session_columns(), selected_rows(day.session_ts, None, query)
+    else:
+        columns, rows = day.event_columns(), selected_rows(day.event_ts, day.event_type, query)
+
+    frame = pd.DataFrame({i: columns[i](rows) for i in set(ids)})
+    dimensions = [c["column_id"] for c in query["columns"] if "transformation_id" not in c]
+    metrics = [(c["column_id"], "nunique" if c["transformation_id"] == "unique_count" else "sum")
+               for c in query["columns"] if "transformation_id" in c]
+    aggregations = {f"m{n}": pd.NamedAgg(column, function) for n, (column, function) in enumerate(metrics)}
+
+    if dimensions:
+        result = frame.groupby(dimensions).agg(**aggregations).reset_index()
+        if query.get("order_by"):
+            position, direction = query["order_by"][0]
+            result = result.sort_values(result.columns[position], ascending=direction != "desc")
+    else:
+        result = pd.DataFrame([[frame[column].agg(function) for column, function in metrics]])
+
+    result = result.iloc[query.get("offset", 0):query.get("offset", 0) + query.get("limit", 100000)]
+    return [[v.item() if hasattr(v, "item") else v for v in row]
+            for row in result.itertuples(index=False)]
+
+
+class FakePiwikHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, compresslevel=1)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = self.path.rstrip("/")
+        server.count(path)
+
+        if server.latency:
+            time.sleep(server.latency * random.uniform(1 - server.jitter, 1 + server.jitter))
+
+        if path == "/auth/token":
+            creds = urllib.parse.parse_qs(body.decode())
+            if not creds.get("client_id") or not creds.get("client_secret"):
+                return self.reply(401, {"errors": [{"title": "invalid client"}]})
+            return self.reply(200, {"token_type": "Bearer", "access_token": server.new_token(),
+                                    "expires_in": server.token_ttl})
+
+        if not server.valid_token(self.headers.get("Authorization", "")):
+            return self.reply(401, {"errors": [{"title": "invalid token"}]})
+
+        query = json.loads(body)
+        if path == "/api/analytics/v1/sessions":
+            return self.reply(200, {"data": raw_rows(server.day_of(query), query, sessions=True)})
+        if path == "/api/analytics/v1/events":
+            return self.reply(200, {"data": raw_rows(server.day_of(query), query, sessions=False)})
+        if path == "/api/analytics/v1/query":
+            return self.reply(200, {"data": aggregated_rows(server.day_of(query), query)})
+        return self.reply(404, {"errors": [{"title": "not found"}]})
+
+
+class FakePiwikServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, day, latency_ms=0, jitter=0.2, token_ttl=1800):
+        super().__init__(address, FakePiwikHandler)
+        self.day = day
+        self.latency = latency_ms / 1000
+        self.jitter = jitter
+        self.token_ttl = token_ttl
+
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.calls = collections.Counter()
+        # date: FakeDay of an earlier day
+        self.past_days = {}
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    # the generated day a query asks for, today's unless it has a date_from
+    def day_of(self, query):
+        if "date_from" not in query:
+            return self.day
+        date = datetime.date.fromisoformat(query["date_from"])
+        days_back = (self.day.date - date).days
+        if days_back <= 0:
+            return self.day
+        with self.lock:
+            day = self.past_days.get(date)
+            if day is None:
+                day = FakeDay(self.day.rows, self.day.seed + days_back,
+                              now=datetime.datetime.combine(date, datetime.time(23, 59, 59)))
+                self.past_days[date] = day
+            return day
+
+    def count(self, path):
+        with self.lock:
+            self.calls[path] += 1
+
+    def new_token(self):
+        with self.lock:
+            token = f"fake-{len(self.tokens)}-{random.getrandbits(32):08x}"
+            self.tokens[token] = time.monotonic() + self.token_ttl
+            return token
+
+    def valid_token(self, authorization):
+        token = authorization.removeprefix("Bearer ")
+        with self.lock:
+            return self.tokens.get(token, 0) > time.monotonic()
+
+
+# starts a server for a generated day on a background thread, port 0 picks a free one
+def start_server(rows, seed=0, latency_ms=0, port=0, token_ttl=1800):
+    server = FakePiwikServer(("127.0.0.1", port), FakeDay(rows, seed), latency_ms,
+                             token_ttl=token_ttl)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Piwik PRO API")
+    parser.add_argument("--rows", type=int, default=100000, help="events of the generated day")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--token-ttl", type=int, default=1800, help="secs a token is valid")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    server = FakePiwikServer(("127.0.0.1", args.port), FakeDay(args.rows, args.seed),
+                             args.latency_ms, token_ttl=args.token_ttl)
+    print(f"fake Piwik PRO API with {args.rows} events on {server.base_url}")
+    server.serve_forever()
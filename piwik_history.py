@@ -0,0 +1,218 @@
+import io
+import os
+import sqlite3
+import datetime
+import functools
+import threading
+import numpy as np
+import pandas as pd
+
+from piwik_api import raw_session_query, raw_event_query, past_day, SESSION_BASE_COLUMNS, EVENT_BASE_COLUMNS
+from piwik_aggregate import EVENT_TYPE_PAGEVIEW, EVENT_TYPE_SEARCH
+from piwik_ingest import query_schema
+from piwik_metrics import column_codes, runs
+from piwik_partition import partitioned_fetch
+from piwik_sites import website_directory
+from piwik_store import STORE_DIRECTORY
+from piwik_timing import recorder
+
+# Same time yesterday and last week ---------------------------------
+#
+# the live numbers are compared with the same window of an earlier day. past days do not change: the
+# first time one is needed its raw rows are downloaded once (in time slices, see piwik_partition) and
+# reduced to per minute arrays, kept in memory and in a history file per website that the day store
+# never prunes, so later comparisons cost no request, in this process or after a restart.
+# a minute holds its sessions, orders and revenue, and the distinct (url, visitor) and (keyword,
+# visitor) pairs of its pageviews and searches as integer codes: a window of the day gives the same
+# distinct counts the live panels compute (see piwik_window), not a sum of per minute counts.
+# a day that ended less than SETTLE_HOURS ago can still get late rows, it is used but not stored.
+
+SETTLE_HOURS = 3
+
+# compared day: how far back it is
+COMPARISONS = {
+    "Yesterday": datetime.timedelta(days=1),
+    "Same day last week": datetime.timedelta(days=7),
+}
+
+
+def minute_of_day(timestamps):
+    return (timestamps.dt.hour * 60 + timestamps.dt.minute).to_numpy(dtype="int16")
+
+
+class DayHistory:
+
+    def __init__(self, day, arrays):
+        self.day = day
+        # minute, sessions, orders, revenue: one entry per minute with sessions or revenue
+        # pair_minute, pair_type, pair_dimension, pair_visitor: distinct per minute
+        self.arrays = arrays
+
+    @classmethod
+    def from_rows(cls, day, session_data, event_data):
+        # like the window buckets, a row fetched twice counts once
+        sessions = session_data.drop_duplicates("session_id", keep="last")
+        per_minute = pd.DataFrame({
+            "minute": minute_of_day(sessions["timestamp"]),
+            "orders": sessions["session_total_ecommerce_conversions"].fillna(0).to_numpy(dtype="int64"),
+        }).groupby("minute").agg(sessions=("orders", "size"), orders=("orders", "sum"))
+
+        events = event_data.drop_duplicates(["session_id", "event_id"], keep="last")
+        event_minutes = minute_of_day(events["timestamp"])
+        revenue = pd.Series(events["revenue"].to_numpy(dtype="float64"), index=event_minutes).groupby(level=0).sum()
+        revenue = revenue[revenue != 0]
+        per_minute = per_minute.join(revenue.rename("revenue"), how="outer").fillna(0)
+
+        # url / keyword code of each pageview / search, -1 when it has none
+        type_ids = events["event_type_id"].to_numpy()
+        dimensions = np.full(len(events), -1, dtype="int64")
+        for event_type, column in ((EVENT_TYPE_PAGEVIEW, "event_url"), (EVENT_TYPE_SEARCH, "search_keyword")):
+            of_type = type_ids == event_type
+            dimensions[of_type] = column_codes(events[column])[0][of_type]
+        visitors = pd.factorize(events["visitor_id"])[0]
+
+        kept = (dimensions >= 0) & (visitors >= 0)
+        pairs = pd.DataFrame({
+            "minute": event_minutes[kept], "type": type_ids[kept],
+            "dimension": dimensions[kept], "visitor": visitors[kept],
+        }).drop_duplicates()
+
+        return cls(day, {
+            "minute": per_minute.index.to_numpy(dtype="int16"),
+            "sessions": per_minute["sessions"].to_numpy(dtype="int32"),
+            "orders": per_minute["orders"].to_numpy(dtype="int32"),
+            "revenue": per_minute["revenue"].to_numpy(dtype="float64"),
+            "pair_minute": pairs["minute"].to_numpy(dtype="int16"),
+            "pair_type": pairs["type"].to_numpy(dtype="int8"),
+            "pair_dimension": pairs["dimension"].to_numpy(dtype="int32"),
+            "pair_visitor": pairs["visitor"].to_numpy(dtype="int32"),
+        })
+
+    def to_bytes(self):
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **self.arrays)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, day, data):
+        with np.load(io.BytesIO(data)) as stored:
+            return cls(day, {name: stored[name] for name in stored.files})
+
+    # numbers of the live panels for the window of `minutes` up to the time of day of then
+    def window(self, then, minutes):
+        a = self.arrays
+        # a history is one day, a window starting before its midnight is cut there
+        last = then.hour * 60 + then.minute
+        first = max(last - minutes + 1, 0)
+
+        in_window = (a["minute"] >= first) & (a["minute"] <= last)
+        totals = {
+            "sessions": int(a["sessions"][in_window].sum()),
+            "orders": int(a["orders"][in_window].sum()),
+            "revenue": round(float(a["revenue"][in_window].sum()), 2),
+        }
+
+        pairs = (a["pair_minute"] >= first) & (a["pair_minute"] <= last)
+        n_visitors = int(a["pair_visitor"].max()) + 1 if len(a["pair_visitor"]) else 1
+        for event_type, name in ((EVENT_TYPE_PAGEVIEW, "pageviews"), (EVENT_TYPE_SEARCH, "searches")):
+            of_type = pairs & (a["pair_type"] == event_type)
+            keys = a["pair_dimension"][of_type].astype("int64") * n_visitors + a["pair_visitor"][of_type]
+            totals[name] = len(runs(np.sort(keys))[0])
+        return totals
+
+
+class HistoryStore:
+
+    def __init__(self, directory=STORE_DIRECTORY, memory_days=8):
+        self.directory = directory
+        self.memory_days = memory_days
+        self.lock = threading.Lock()
+        # (piwik_domain, website_id, day): (DayHistory, settled)
+        self.days = {}
+        # one download per day at a time, concurrent viewers wait for it
+        self.day_locks = {}
+
+    def path(self, piwik_domain, website_id):
+        return os.path.join(website_directory(self.directory, piwik_domain, website_id), "history.sqlite")
+
+    def connect(self, piwik_domain, website_id):
+        path = self.path(piwik_domain, website_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        con = sqlite3.connect(path)
+        con.execute("CREATE TABLE IF NOT EXISTS days (day TEXT PRIMARY KEY, history BLOB)")
+        return con
+
+    def load(self, piwik_domain, website_id, day):
+        if not os.path.exists(self.path(piwik_domain, website_id)):
+            return None
+        con = self.connect(piwik_domain, website_id)
+        try:
+            row = con.execute("SELECT history FROM days WHERE day = ?", (day.isoformat(),)).fetchone()
+        finally:
+            con.close()
+        return DayHistory.from_bytes(day, row[0]) if row else None
+
+    def save(self, piwik_domain, website_id, history):
+        # comparisons keep working from memory when the disk is not writable
+        try:
+            con = self.connect(piwik_domain, website_id)
+            try:
+                with con:
+                    con.execute("INSERT OR REPLACE INTO days (day, history) VALUES (?, ?)",
+                                (history.day.isoformat(), history.to_bytes()))
+            finally:
+                con.close()
+        except (OSError, sqlite3.Error) as e:
+            print(f'history of {website_id} {history.day} not stored: {e}')
+
+    # fetch(query, url, schema) like piwik_query, urls from piwik_api.api_urls
+    def download(self, fetch, urls, website_id, day):
+        since = datetime.datetime.combine(day, datetime.time())
+        until = since + datetime.timedelta(days=1)
+
+        frames = []
+        for query, url, base_columns in ((raw_session_query(website_id), urls["sessions"], SESSION_BASE_COLUMNS),
+                                         (raw_event_query(website_id), urls["events"], EVENT_BASE_COLUMNS)):
+            query = past_day(query, day)
+            with recorder.stage("history fetch", query=url.rstrip("/").rsplit("/", 1)[-1]) as stage:
+                rows, _ = partitioned_fetch(
+                    functools.partial(fetch, schema=query_schema(base_columns, query)), query, url, since, until)
+                stage.rows = len(rows)
+            frames.append(rows)
+
+        with recorder.stage("history aggregation"):
+            return DayHistory.from_rows(day, *frames)
+
+    # per minute history of a past day of a website, downloaded the first time it is asked for
+    def day(self, fetch, urls, piwik_domain, website_id, day, now=None):
+        now = now or datetime.datetime.now()
+        settled = now >= datetime.datetime.combine(day, datetime.time()) + datetime.timedelta(
+            days=1, hours=SETTLE_HOURS)
+        key = (piwik_domain, website_id, day)
+
+        with self.lock:
+            day_lock = self.day_locks.setdefault(key, threading.Lock())
+
+        with day_lock:
+            with self.lock:
+                entry = self.days.get(key)
+            # a day used before it settled is downloaded again once it has
+            if entry is not None and (entry[1] or not settled):
+                return entry[0]
+
+            history = self.load(piwik_domain, website_id, day) if entry is None else None
+            if history is None:
+                history = self.download(fetch, urls, website_id, day)
+                if settled:
+                    self.save(piwik_domain, website_id, history)
+
+            with self.lock:
+                self.days[key] = (history, settled)
+                oldest = now.date() - datetime.timedelta(days=self.memory_days)
+                for old in [k for k in self.days if k[2] < oldest]:
+                    del self.days[old]
+                    self.day_locks.pop(old, None)
+            return history
+
+
+history_store = HistoryStore()
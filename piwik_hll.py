@@ -0,0 +1,92 @@
+import math
+import numpy as np
+import pandas as pd
+
+# Approximate distinct counts ---------------------------------
+#
+# HyperLogLog sketch of 64-bit hashes. sketches of the same precision merge by taking the max of
+# each register, so per minute and per dimension value sketches add up to any window without
+# keeping the ids themselves. a sketch stays sparse (register: rank dict) until it holds
+# more than a few hundred registers, small groups (a rare url in one minute) cost a few bytes.
+# the relative standard error is 1.04 / sqrt(2 ** precision), 1.6% with the default 12.
+# the sketch has the add / update / len interface of the set it replaces in exact mode.
+
+DEFAULT_PRECISION = 12
+
+
+# stable 64-bit hashes of a column, computed once per batch of rows
+def hash_values(values):
+    return pd.util.hash_array(np.asarray(values, dtype=object))
+
+
+def relative_error(precision=DEFAULT_PRECISION):
+    return 1.04 / math.sqrt(2 ** precision)
+
+
+class HyperLogLog:
+
+    def __init__(self, precision=DEFAULT_PRECISION):
+        self.precision = precision
+        self.size = 2 ** precision
+        self.registers = None
+        self.sparse = {}
+
+    # h is a 64-bit hash: the first bits pick the register, the rank is the position of the first 1
+    def add(self, h):
+        h = int(h)
+        bits = 64 - self.precision
+        register = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+
+        if self.registers is not None:
+            if rank > self.registers[register]:
+                self.registers[register] = rank
+        elif rank > self.sparse.get(register, 0):
+            self.sparse[register] = rank
+            if len(self.sparse) > self.size // 8:
+                self.densify()
+
+    def densify(self):
+        self.registers = np.zeros(self.size, dtype=np.uint8)
+        if self.sparse:
+            self.registers[list(self.sparse)] = list(self.sparse.values())
+        self.sparse = {}
+
+    def update(self, other):
+        if other.precision != self.precision:
+            raise ValueError("HyperLogLog sketches of different precision can't be merged")
+
+        if other.registers is not None:
+            if self.registers is None:
+                self.densify()
+            np.maximum(self.registers, other.registers, out=self.registers)
+        elif self.registers is not None:
+            for register, rank in other.sparse.items():
+                if rank > self.registers[register]:
+                    self.registers[register] = rank
+        else:
+            for register, rank in other.sparse.items():
+                if rank > self.sparse.get(register, 0):
+                    self.sparse[register] = rank
+            if len(self.sparse) > self.size // 8:
+                self.densify()
+
+    def estimate(self):
+        if self.registers is None:
+            ranks = np.fromiter(self.sparse.values(), dtype=np.float64, count=len(self.sparse))
+            zeros = self.size - len(ranks)
+            harmonic = zeros + np.sum(2.0 ** -ranks)
+        else:
+            zeros = int(np.count_nonzero(self.registers == 0))
+            harmonic = np.sum(2.0 ** -self.registers.astype(np.float64))
+
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size ** 2 / harmonic
+
+        # small cardinalities: linear counting on the empty registers is more accurate
+        if estimate <= 2.5 * self.size and zeros > 0:
+            estimate = self.size * math.log(self.size / zeros)
+        return estimate
+
+    def __len__(self):
+        return round(self.estimate())
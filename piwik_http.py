@@ -0,0 +1,263 @@
+import os
+import math
+import time
+import random
+import bisect
+import threading
+import urllib.parse
+import collections
+import concurrent.futures
+import requests
+
+from piwik_timing import recorder
+
+# Resilient requests to Piwik PRO ---------------------------------
+#
+# every request goes through one pooled session with connect / read timeouts. idempotent requests
+# (all the data queries are reads) are retried on timeouts, connection errors and 5xx responses with
+# jittered exponential backoff. with hedging on (PIWIK_HEDGE_REQUESTS=1) a request still running after
+# its endpoint's p95 latency gets a duplicate, the first answer wins. after failures_to_open failures
+# in a row an endpoint's circuit opens: requests fail at once for cooldown secs, so the dashboard
+# serves its last good data (see piwik_cache) instead of every panel waiting on timeouts.
+# latencies are kept per endpoint as histograms, to tune the timeouts and the hedging threshold.
+# an endpoint is a host and path name, so a failing domain does not pause the requests of another.
+
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 60
+RETRY_STATUSES = {500, 502, 503, 504}
+HEDGE_REQUESTS = os.environ.get("PIWIK_HEDGE_REQUESTS") == "1"
+
+
+class PiwikError(Exception):
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+# 429 response: Piwik PRO asks for fewer requests, retry_after is in secs when it says so
+class PiwikRateLimited(PiwikError):
+
+    def __init__(self, endpoint, retry_after=None):
+        super().__init__(f"{endpoint} rate limited by Piwik PRO", 429)
+        self.retry_after = retry_after
+
+
+class CircuitOpen(PiwikError):
+    pass
+
+
+# endpoint name used to label timings, e.g. "events"
+def endpoint_name(url):
+    return url.rstrip("/").rsplit("/", 1)[-1]
+
+
+# error message of a failed response, from Piwik PRO's {"errors": [{"title": ...}]} body if it has one
+def response_error(response):
+    try:
+        errors = response.json().get("errors") or []
+        detail = "; ".join(str(e.get("title") or e.get("detail") or e) for e in errors)
+    except ValueError:
+        detail = ""
+    return f"{endpoint_name(response.url or '')} answered {response.status_code} {response.reason or ''}".strip() + (
+        f": {detail}" if detail else "")
+
+
+class LatencyHistogram:
+
+    # secs, upper bounds of the buckets
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+    def __init__(self, recent=500):
+        self.lock = threading.Lock()
+        self.counts = [0] * len(self.BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        # recent samples for the quantiles
+        self.samples = collections.deque(maxlen=recent)
+
+    def observe(self, secs):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.BUCKETS, secs)] += 1
+            self.count += 1
+            self.sum += secs
+            self.samples.append(secs)
+
+    def quantile(self, q):
+        with self.lock:
+            if not self.samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class CircuitBreaker:
+
+    def __init__(self, failures_to_open=5, cooldown=30):
+        self.failures_to_open = failures_to_open
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+
+    # closed, or open for longer than cooldown: one request is let through to test the endpoint
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failures_to_open:
+                self.opened_at = time.monotonic()
+
+    @property
+    def state(self):
+        return "open" if self.opened_at is not None else "closed"
+
+
+class HttpClient:
+
+    def __init__(self, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), retries=3, backoff=0.5,
+                 max_backoff=8, hedge=HEDGE_REQUESTS, hedge_quantile=0.95, hedge_min_samples=20):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=32)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_pool = concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix="piwik-hedge")
+
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.breakers = {}
+        # (host, endpoint name): {"retries": n, "hedged": n}
+        self.counters = collections.defaultdict(collections.Counter)
+
+    # (host, endpoint name) of a url and its histogram and circuit breaker
+    def endpoint(self, url):
+        key = (urllib.parse.urlsplit(url).netloc, endpoint_name(url))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = LatencyHistogram()
+                self.breakers[key] = CircuitBreaker()
+            return key, self.histograms[key], self.breakers[key]
+
+    def send(self, url, kwargs, histogram):
+        start = time.perf_counter()
+        response = self.session.post(url, timeout=self.timeout, **kwargs)
+        histogram.observe(time.perf_counter() - start)
+        return response
+
+    # a duplicate request goes out when the first one is slower than the endpoint usually is
+    def hedged_send(self, key, url, kwargs, histogram):
+        threshold = histogram.quantile(self.hedge_quantile)
+        if threshold is None or histogram.count < self.hedge_min_samples:
+            return self.send(url, kwargs, histogram)
+
+        first = self.hedge_pool.submit(self.send, url, kwargs, histogram)
+        done, _ = concurrent.futures.wait([first], timeout=threshold)
+        if done:
+            return first.result()
+
+        self.counters[key]["hedged"] += 1
+        second = self.hedge_pool.submit(self.send, url, kwargs, histogram)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    # the slower response is closed unread, its connection goes back to the pool
+                    for loser in pending:
+                        loser.add_done_callback(lambda f: f.exception() is None and f.result().close())
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def post(self, url, idempotent=True, **kwargs):
+        key, histogram, breaker = self.endpoint(url)
+        name = " ".join(key)
+
+        for attempt in range(self.retries + 1):
+            if not breaker.allow():
+                raise CircuitOpen(f"{name}: Piwik PRO failed {breaker.failures} times in a row, "
+                                  f"requests paused for {breaker.cooldown} secs")
+            try:
+                if self.hedge and idempotent:
+                    response = self.hedged_send(key, url, kwargs, histogram)
+                else:
+                    response = self.send(url, kwargs, histogram)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                breaker.failure()
+                error = PiwikError(f"{name}: {type(e).__name__}: {e}")
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    breaker.success()
+                    return response
+                breaker.failure()
+                error = PiwikError(response_error(response), response.status_code)
+                # a streamed response holds its connection until it is closed
+                response.close()
+
+            if not idempotent or attempt == self.retries:
+                raise error
+            self.counters[key]["retries"] += 1
+            # full jitter, concurrent clients do not retry in step
+            time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+    # one row per endpoint, for the performance panel
+    def stats(self):
+        with self.lock:
+            endpoints = list(self.histograms.items())
+        rows = []
+        for (host, name), histogram in endpoints:
+            rows.append({
+                "host": host,
+                "endpoint": name,
+                "requests": histogram.count,
+                "p50 secs": round(histogram.quantile(0.5) or 0, 3),
+                "p95 secs": round(histogram.quantile(0.95) or 0, 3),
+                "p99 secs": round(histogram.quantile(0.99) or 0, 3),
+                "retries": self.counters[(host, name)]["retries"],
+                "hedged": self.counters[(host, name)]["hedged"],
+                "circuit": self.breakers[(host, name)].state,
+            })
+        return rows
+
+    def prometheus(self):
+        with self.lock:
+            endpoints = list(self.histograms.items())
+        lines = ["# HELP piwik_request_seconds Latency of Piwik PRO requests",
+                 "# TYPE piwik_request_seconds histogram"]
+        for (host, name), histogram in endpoints:
+            labels = f'host="{host}",endpoint="{name}"'
+            with histogram.lock:
+                cumulative = 0
+                for bound, count in zip(histogram.BUCKETS, histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else bound
+                    lines.append(f'piwik_request_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+                lines.append(f'piwik_request_seconds_sum{{{labels}}} {histogram.sum}')
+                lines.append(f'piwik_request_seconds_count{{{labels}}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+
+http = HttpClient()
+recorder.collectors.append(http.prometheus)
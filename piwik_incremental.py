@@ -0,0 +1,189 @@
+import sqlite3
+import datetime
+import threading
+import functools
+
+from piwik_ingest import query_schema, frame_types, concat_frames
+from piwik_partition import partitioned_fetch
+from piwik_api import endpoint_name, PiwikRateLimited
+from piwik_timing import recorder
+
+# Incremental fetching of today's raw data ---------------------------------
+#
+# the first refresh of the day downloads the whole day. afterwards only rows newer than the
+# high-water mark (latest timestamp already loaded) are requested, minus a small overlap so rows
+# that arrive late at Piwik PRO are still picked up. overlapping rows are deduplicated on the key
+# columns, keeping the newest version (e.g. a session whose order count went up since last time).
+# a session row is stamped with its start but changes for as long as the session runs, so session
+# queries overlap by SESSION_OVERLAP_MINUTES (Piwik PRO's session timeout): a session converting up
+# to that long after the newest session start is fetched again with its new order count.
+# the requested range is fetched in concurrent time slices, see piwik_partition.
+# with window_minutes only the last minutes are fetched and kept instead of the whole day, for
+# views that need row level data of the live window only.
+# with a store (piwik_store.DayStore) fetched rows are also kept on disk and the first refresh of the
+# process starts from the stored rows, fetching only what came after them.
+# with buckets (piwik_window.SessionBuckets / EventBuckets) every merged row is also added to the
+# per minute live window aggregates.
+# with a poll (piwik_poll.AdaptivePoll) a refresh first probes whether today's rows changed and
+# returns the loaded data without downloading when they did not, or when the poll is backing off.
+
+
+SESSION_OVERLAP_MINUTES = 30
+
+
+class IncrementalQuery:
+
+    def __init__(self, query, url, base_columns, key_columns, overlap_minutes=5,
+                 slice_minutes=60, max_workers=4, window_minutes=None, store=None, store_key=None,
+                 buckets=None, poll=None):
+        self.query = query
+        self.url = url
+        self.schema = query_schema(base_columns, query)
+        self.key_columns = key_columns
+        self.overlap = datetime.timedelta(minutes=overlap_minutes)
+        self.slice_minutes = slice_minutes
+        self.max_workers = max_workers
+        self.window = datetime.timedelta(minutes=window_minutes) if window_minutes else None
+        # store_key is (piwik_domain, website_id, table name)
+        self.store = store
+        self.store_key = store_key
+        self.buckets = buckets
+        self.poll = poll
+        # labels the timings of this query
+        self.name = store_key[2] if store_key else endpoint_name(url)
+        # refreshes of the same query never run at the same time
+        self.lock = threading.Lock()
+
+        self.reset()
+
+    def reset(self, day=None):
+        self.day = day
+        self.data = None
+        self.watermark = None
+        # rows returned by the last refresh (before deduplication against the loaded day)
+        self.last_delta = None
+        # time slices of the last refresh that still hit the query limit
+        self.truncated = []
+        # start of the time range loaded without gaps
+        self.covered_since = None
+
+    # memory held by today's rows, see piwik_tenants
+    def nbytes(self):
+        data = self.data
+        return 0 if data is None else int(data.memory_usage(deep=True).sum())
+
+    def first_since(self, now):
+        since = datetime.datetime.combine(now.date(), datetime.time())
+        if self.window is not None:
+            since = max(since, now - self.window)
+        return since
+
+    def next_since(self, now):
+        if self.watermark is None:
+            return self.first_since(now)
+        return max(self.watermark - self.overlap, self.first_since(now))
+
+    def load_stored(self, now):
+        piwik_domain, website_id, table = self.store_key
+        self.store.prune(now.date())
+
+        stored, covered_since = self.store.load(
+            piwik_domain, website_id, now.date(), table, frame_types(self.schema))
+
+        # stored rows that start later than what this query needs would leave a gap
+        if stored is not None and covered_since <= self.first_since(now):
+            self.merge(stored, now)
+            self.covered_since = covered_since
+            print(f'{table}: {len(stored)} rows loaded from the day store')
+
+    def save_stored(self, new_rows, now):
+        piwik_domain, website_id, table = self.store_key
+        # the dashboard keeps working from memory when the disk is not writable
+        try:
+            self.store.save(piwik_domain, website_id, now.date(), table, self.key_columns,
+                            new_rows, self.covered_since)
+        except (OSError, sqlite3.Error) as e:
+            print(f'{table}: day store not updated: {e}')
+
+    # fetch(query, url, schema) must return the typed response DataFrame, like piwik_query does
+    def refresh(self, fetch, now=None):
+        with self.lock:
+            return self.locked_refresh(fetch, now)
+
+    def locked_refresh(self, fetch, now):
+        now = now or datetime.datetime.now()
+
+        # a new day starts from scratch, "today" moved on
+        if self.day != now.date():
+            self.reset(now.date())
+            if self.store is not None:
+                self.load_stored(now)
+        elif self.poll is not None and self.data is not None and not self.should_fetch(fetch):
+            self.last_delta = self.data.iloc[:0]
+            return self.data
+
+        since = self.next_since(now)
+        try:
+            with recorder.stage("fetch", query=self.name) as stage:
+                new_rows, self.truncated = partitioned_fetch(
+                    functools.partial(fetch, schema=self.schema), self.query, self.url,
+                    since, now,
+                    slice_minutes=self.slice_minutes, max_workers=self.max_workers)
+                stage.rows = len(new_rows)
+        except PiwikRateLimited as e:
+            if self.poll is None or self.data is None:
+                raise
+            # the loaded rows are kept until Piwik PRO accepts requests again
+            self.poll.throttled(e.retry_after)
+            print(f'{self.name}: {e}, next try in {self.poll.interval:.0f} secs')
+            return self.data
+
+        with recorder.stage("merge", query=self.name) as stage:
+            self.merge(new_rows, now)
+            stage.rows = len(self.data)
+        if self.poll is not None:
+            self.poll.commit()
+
+        # each refresh continues the range loaded before it
+        self.covered_since = since if self.covered_since is None else min(self.covered_since, since)
+        if self.store is not None:
+            with recorder.stage("store save", query=self.name) as stage:
+                self.save_stored(new_rows, now)
+                stage.rows = len(new_rows)
+
+        return self.data
+
+    # False while the poll backs off or when its probe found no change since the last refresh
+    def should_fetch(self, fetch):
+        if not self.poll.due():
+            return False
+        try:
+            with recorder.stage("probe", query=self.name):
+                return self.poll.changed(fetch)
+        except PiwikRateLimited as e:
+            self.poll.throttled(e.retry_after)
+            print(f'{self.name}: {e}, next try in {self.poll.interval:.0f} secs')
+            return False
+
+    def merge(self, new_rows, now):
+        self.last_delta = new_rows
+        if self.buckets is not None and not new_rows.empty:
+            with recorder.stage("window buckets", query=self.name) as stage:
+                self.buckets.add(new_rows)
+                stage.rows = len(new_rows)
+
+        if self.data is None:
+            data = new_rows
+        elif new_rows.empty:
+            data = self.data
+        else:
+            data = concat_frames([self.data, new_rows])
+            data = data.drop_duplicates(subset=self.key_columns, keep="last")
+
+        if self.window is not None:
+            data = data.loc[data["timestamp"] >= now - self.window]
+
+        self.data = data.sort_values('timestamp', ascending=False, ignore_index=True)
+
+        if not self.data.empty:
+            self.watermark = self.data["timestamp"].max()
@@ -0,0 +1,215 @@
+import json
+import itertools
+import numpy as np
+import pandas as pd
+
+# ijson (in requirements.txt) parses rows off the download stream as it arrives. without it the whole
+# body is decoded at once, by orjson when it is installed (several times faster) or json
+try:
+    import ijson
+except ImportError:
+    ijson = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Typed columnar ingest of raw data API responses ---------------------------------
+#
+# the response rows are transposed once into columns and each column is built straight into its
+# declared type, instead of a DataFrame of python objects that is renamed and converted afterwards.
+# low cardinality text becomes categorical, which is what keeps memory per viewer down.
+
+# declared type of each raw data column. "text" columns use pandas' default string storage
+COLUMN_TYPES = {
+    "session_id": "text",
+    "event_id": "text",
+    "visitor_id": "text",
+    "timestamp": "datetime64[ns]",
+    "source": "category",
+    "medium": "category",
+    "campaign_name": "category",
+    "session_total_ecommerce_conversions": "int32",
+    # [id, name] pairs, split into event_type_id (int8) and event_type_name (category)
+    "event_type": "event_type",
+    "event_url": "category",
+    "search_keyword": "category",
+    "revenue": "float32",
+    "order_id": "text",
+}
+
+
+# (column, type) pairs of a raw query response: the fixed base columns followed by the requested ones
+def query_schema(base_columns, query):
+    columns = list(base_columns)
+    for i in query["columns"]:
+        for v in i.values():
+            columns.append(v)
+    return [(c, COLUMN_TYPES.get(c, "text")) for c in columns]
+
+
+def typed_column(values, column_type):
+    if column_type == "datetime64[ns]":
+        return pd.to_datetime(pd.Series(values, dtype="object")).astype(column_type)
+    if column_type == "category":
+        return pd.Categorical(pd.Series(values, dtype="object"))
+    if column_type.startswith("int"):
+        return pd.to_numeric(pd.Series(values, dtype="object")).fillna(0).astype(column_type)
+    if column_type.startswith("float"):
+        return pd.to_numeric(pd.Series(values, dtype="object")).astype(column_type)
+    return pd.Series(values)
+
+
+def build_frame(rows, schema):
+    builder = FrameBuilder(schema)
+    builder.add(rows)
+    return builder.frame()
+
+
+# Streaming decode ---------------------------------
+#
+# rows are typed into column buffers CHUNK_ROWS at a time, so only one chunk of rows is held as python
+# objects instead of the whole response next to the frame built from it. with ijson the rows are parsed
+# off the gunzipped download stream and the body is never held whole, without it the body is decoded
+# at once (orjson or json) and typed chunk by chunk.
+
+CHUNK_ROWS = 20000
+
+
+# codes of a categorical column, categories are numbered as they first appear
+class CategoryBuffer:
+
+    def __init__(self):
+        self.codes = {}
+        self.chunks = []
+
+    def add(self, values):
+        chunk_codes, uniques = pd.factorize(np.asarray(values, dtype="object"))
+        if not len(uniques):
+            self.chunks.append(chunk_codes.astype("int32"))
+            return
+        # codes of the chunk's values among all the values seen so far
+        codes = self.codes
+        renumber = np.fromiter((codes.setdefault(v, len(codes)) for v in uniques),
+                               dtype="int32", count=len(uniques))
+        self.chunks.append(np.where(chunk_codes >= 0, renumber[chunk_codes], -1).astype("int32"))
+
+    def column(self):
+        codes = np.concatenate(self.chunks) if self.chunks else np.empty(0, dtype="int32")
+        categories = pd.Index(list(self.codes), dtype="object")
+        # sorted categories, like pd.Categorical of the whole column
+        try:
+            order = categories.argsort()
+        except TypeError:
+            order = np.arange(len(categories))
+        if len(categories):
+            renumber = np.empty(len(order), dtype="int32")
+            renumber[order] = np.arange(len(order), dtype="int32")
+            codes = np.where(codes >= 0, renumber[codes], -1)
+        return pd.Categorical.from_codes(codes, categories[order])
+
+
+# typed chunks of any other column, concatenated once at the end
+class ChunkBuffer:
+
+    def __init__(self, column_type):
+        self.column_type = column_type
+        self.chunks = []
+
+    def add(self, values):
+        self.chunks.append(typed_column(values, self.column_type))
+
+    def column(self):
+        if not self.chunks:
+            return typed_column([], self.column_type)
+        if len({str(c.dtype) for c in self.chunks}) > 1:
+            # e.g. text chunks where one had no values: the whole column is typed at once
+            values = np.concatenate([c.to_numpy(dtype="object") for c in self.chunks])
+            return typed_column(list(values), self.column_type)
+        return pd.concat(self.chunks, ignore_index=True)
+
+
+class FrameBuilder:
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.rows = 0
+        self.buffers = {}
+        for name, column_type in schema:
+            if column_type == "category":
+                self.buffers[name] = CategoryBuffer()
+            elif column_type != "event_type":
+                self.buffers[name] = ChunkBuffer(column_type)
+
+        # event_type has a list type column. it is split into two columns, the original is not kept
+        if any(column_type == "event_type" for _, column_type in schema):
+            self.buffers["event_type_id"] = ChunkBuffer("int8")
+            self.buffers["event_type_name"] = CategoryBuffer()
+
+    def add(self, rows):
+        if not rows:
+            return
+        self.rows += len(rows)
+        for (name, column_type), values in zip(self.schema, zip(*rows)):
+            if column_type == "event_type":
+                self.buffers["event_type_id"].add([x[0] for x in values])
+                self.buffers["event_type_name"].add([x[1] for x in values])
+            else:
+                self.buffers[name].add(values)
+
+    def frame(self):
+        return pd.DataFrame({name: buffer.column() for name, buffer in self.buffers.items()})
+
+
+def decode_json(body):
+    return orjson.loads(body) if orjson is not None else json.loads(body)
+
+
+# chunks of at most chunk_rows rows of a raw data API response's "data", from a requests response
+# sent with stream=True
+def response_rows(response, chunk_rows=CHUNK_ROWS):
+    if ijson is None:
+        rows = decode_json(response.content)["data"]
+        for start in range(0, len(rows), chunk_rows):
+            yield rows[start:start + chunk_rows]
+        return
+
+    # the raw stream, gunzipped by urllib3 as it is read
+    response.raw.decode_content = True
+    items = ijson.items(response.raw, "data.item", use_float=True)
+    while chunk := list(itertools.islice(items, chunk_rows)):
+        yield chunk
+
+
+# (column, type) pairs of the frames build_frame returns for a schema
+def frame_types(schema):
+    types = [(c, t) for c, t in schema if t != "event_type"]
+    if len(types) < len(schema):
+        types += [("event_type_id", "int8"), ("event_type_name", "category")]
+    return types
+
+
+# types the plain columns of a frame read back from storage, see piwik_store
+def apply_types(piwik_data, types):
+    return pd.DataFrame({c: typed_column(piwik_data[c], t) for c, t in types})
+
+
+# concatenates typed frames, keeping categorical columns categorical (plain concat turns
+# categoricals with different categories into object columns)
+def concat_frames(frames):
+    frames = [f for f in frames if not f.empty] or list(frames)[:1]
+    category_columns = [c for c in frames[0].columns
+                        if isinstance(frames[0][c].dtype, pd.CategoricalDtype)]
+
+    for column in category_columns:
+        categories = pd.Index(pd.unique(np.concatenate(
+            [f[column].cat.categories.to_numpy(dtype="object") for f in frames])))
+        frames = [f.assign(**{column: f[column].cat.set_categories(categories)}) for f in frames]
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def bytes_per_row(piwik_data):
+    if piwik_data.empty:
+        return 0
+    return piwik_data.memory_usage(index=False, deep=True).sum() / len(piwik_data)
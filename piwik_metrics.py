@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+
+from piwik_aggregate import EVENT_TYPE_PAGEVIEW, EVENT_TYPE_SEARCH, conversion_rate
+from piwik_timing import recorder
+
+# Today's totals from raw rows ---------------------------------
+#
+# the numbers of the "Today's Total..." panels computed client side from today's raw session and
+# event rows, used by the dashboard and by the collector (--raw-totals). the sources table is one
+# groupby over the sessions. pageviews per url and searches per keyword come out of one pass over
+# the events of both types: every (event type, url or keyword, visitor) is encoded as one integer,
+# so a single unique count gives the distinct visitors of every url and keyword and of each type,
+# instead of filtering and grouping the events once per table.
+
+# event type: (dimension column, table key, table dimension name, table value name, total key)
+EVENT_TABLES = {
+    EVENT_TYPE_PAGEVIEW: ("event_url", "pageviews_table", "url", "pageviews", "pageviews"),
+    EVENT_TYPE_SEARCH: ("search_keyword", "searches_table", "search_keyword", "unique_searches", "searches"),
+}
+
+# dashboard section: event types it needs
+SECTION_EVENT_TYPES = {
+    "total_pageviews": EVENT_TYPE_PAGEVIEW,
+    "total_searches": EVENT_TYPE_SEARCH,
+}
+
+
+# integer codes of a column (-1 missing) and the values they stand for, in groupby's order
+def column_codes(column):
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.codes.to_numpy(dtype="int64"), column.cat.categories
+    codes, uniques = pd.factorize(column, sort=True)
+    return codes.astype("int64"), uniques
+
+
+# distinct values of a sorted array and how many times each one appears
+def runs(values):
+    if not len(values):
+        return values, np.empty(0, dtype="int64")
+    starts = np.flatnonzero(np.concatenate(([True], values[1:] != values[:-1])))
+    return values[starts], np.diff(np.append(starts, len(values)))
+
+
+def session_totals(session_data):
+    df_total_source = session_data.groupby(["source", "medium", "campaign_name"], observed=True).agg(
+        {"session_id": "count", "session_total_ecommerce_conversions": "sum"}).reset_index()
+    df_total_source.rename(columns={
+        'session_id': 'sessions', 'session_total_ecommerce_conversions': 'orders'}, inplace=True)
+
+    return {
+        "orders": round(session_data["session_total_ecommerce_conversions"].sum()),
+        "sessions": session_data["session_id"].nunique(),
+        "sources": conversion_rate(df_total_source),
+    }
+
+
+# distinct visitors per event type and per url / keyword of that type, for the given event types
+def event_totals(event_data, event_types):
+    type_ids = event_data["event_type_id"].to_numpy()
+    selected = np.isin(type_ids, event_types)
+    type_ids = type_ids[selected].astype("int64")
+    visitors = pd.factorize(event_data["visitor_id"])[0][selected].astype("int64")
+
+    # url or keyword code of each event, by its type
+    dimensions = np.full(len(type_ids), -1, dtype="int64")
+    labels = {}
+    for event_type in event_types:
+        codes, labels[event_type] = column_codes(event_data[EVENT_TABLES[event_type][0]])
+        of_type = type_ids == event_type
+        dimensions[of_type] = codes[selected][of_type]
+
+    n_visitors = int(visitors.max()) + 1 if len(visitors) else 1
+    n_dimensions = max([len(v) for v in labels.values()] + [0]) + 1
+    counted = visitors >= 0
+
+    # one key per distinct (type, dimension + 1, visitor): missing dimensions are counted in the type's
+    # total but not in its table
+    keys, _ = runs(np.sort((type_ids[counted] * n_dimensions + dimensions[counted] + 1) * n_visitors
+                           + visitors[counted]))
+    groups = keys // n_visitors
+    group_types, group_dimensions = groups // n_dimensions, groups % n_dimensions - 1
+
+    totals = {}
+    for event_type in event_types:
+        _, table_key, dimension_name, value_name, total_key = EVENT_TABLES[event_type]
+        of_type = group_types == event_type
+        totals[total_key] = len(runs(np.sort(keys[of_type] % n_visitors))[0])
+
+        # keys are sorted, so are the dimensions of a type
+        dimension_codes, counts = runs(group_dimensions[of_type & (group_dimensions >= 0)])
+        column = event_data[EVENT_TABLES[event_type][0]]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            index = pd.CategoricalIndex(pd.Categorical.from_codes(dimension_codes, labels[event_type]),
+                                        name=dimension_name)
+        else:
+            index = pd.Index(labels[event_type].take(dimension_codes), name=dimension_name)
+        table = pd.Series(counts, index=index, name=value_name)
+        totals[table_key] = table.reset_index()
+
+    return totals
+
+
+@recorder.timed("aggregation")
+def raw_totals(session_data, event_data, sections):
+    totals = {}
+
+    if "total_sessions" in sections:
+        totals.update(session_totals(session_data))
+
+        # Total Ecommerce Revenue from today, added up in float64: revenue is stored as float32, whose
+        # sum of a day's prices loses the cents
+        totals["revenue"] = round(event_data['revenue'].astype("float64").sum(), 2)
+
+    event_types = [SECTION_EVENT_TYPES[s] for s in sections if s in SECTION_EVENT_TYPES]
+    if event_types:
+        totals.update(event_totals(event_data, event_types))
+
+    return totals
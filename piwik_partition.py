@@ -0,0 +1,75 @@
+import datetime
+import concurrent.futures
+
+from piwik_api import timestamp_filter
+from piwik_ingest import concat_frames
+
+# Time partitioned fetching ---------------------------------
+#
+# a single raw data request is capped by its "limit" (100000 rows), anything past it is silently
+# dropped. the requested range is split into time slices that are fetched concurrently. a slice
+# that comes back full is split in two and fetched again until it is under the limit or it is
+# min_slice_seconds long, in which case it is reported as truncated.
+
+
+def time_slices(since, until, slice_minutes):
+    step = datetime.timedelta(minutes=slice_minutes)
+    slices = []
+    start = since
+    while start + step < until:
+        slices.append((start, start + step))
+        start = start + step
+    # the last slice is left open so rows stamped slightly after "now" are not missed
+    slices.append((start, None))
+    return slices
+
+
+def split_slice(time_slice, now):
+    since, until = time_slice
+    middle = since + ((until or now) - since) / 2
+    middle = middle.replace(microsecond=0)
+    return [(since, middle), (middle, until)]
+
+
+# fetch(query, url) returns the typed response DataFrame, like piwik_query does with a schema
+# returns the concatenated rows and the list of slices that were still truncated
+def partitioned_fetch(fetch, query, url, since, now=None, slice_minutes=60, max_workers=4,
+                      min_slice_seconds=60):
+    now = now or datetime.datetime.now()
+    limit = query["limit"]
+
+    frames = []
+    truncated = []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+
+        def submit(time_slice):
+            slice_query = timestamp_filter(query, since=time_slice[0], until=time_slice[1])
+            return pool.submit(fetch, slice_query, url)
+
+        pending = {submit(s): s for s in time_slices(since, now, slice_minutes)}
+
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                time_slice = pending.pop(future)
+                slice_data = future.result()
+
+                if len(slice_data) < limit:
+                    frames.append(slice_data)
+                    continue
+
+                slice_end = time_slice[1] or now
+                if (slice_end - time_slice[0]).total_seconds() <= min_slice_seconds:
+                    print(f'slice {time_slice[0]} - {time_slice[1]} is truncated at {limit} rows')
+                    truncated.append(time_slice)
+                    frames.append(slice_data)
+                    continue
+
+                # the slice hit the limit, fetch it again in two halves
+                for half in split_slice(time_slice, now):
+                    pending[submit(half)] = half
+
+    return concat_frames(frames), truncated
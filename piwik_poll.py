@@ -0,0 +1,109 @@
+import copy
+import time
+import threading
+
+from piwik_aggregate import aggregate_query, aggregate_schema
+
+# Change detection and adaptive polling ---------------------------------
+#
+# before an incremental refresh downloads rows, a probe asks the aggregated query endpoint for a
+# few numbers of today's rows (count and a sum, for sessions the order count: an order updates an
+# existing session without adding one). when they did not change since the last refresh there is
+# nothing new to download and the refresh is skipped. a probe's numbers only count as downloaded once
+# the refresh that follows it merged its rows (commit), a failed download is tried again next time.
+# the time between probes follows the traffic: roughly the time `target_rows` new rows take to
+# arrive, between min_interval and max_interval secs. quiet periods back off, a 429 response backs
+# off at least as long as Piwik PRO asks. min_interval 0 polls at the dashboard's own refresh rate.
+
+# name of the raw query: metrics of its probe, see piwik_aggregate.aggregate_query
+PROBE_METRICS = {
+    "sessions": [("sessions", "session_id", "unique_count"),
+                 ("orders", "session_total_ecommerce_conversions", "sum")],
+    "events": [("events", "event_id", "unique_count"),
+               ("revenue", "revenue", "sum")],
+}
+
+
+# aggregated query over the same rows (website, day and filters) as a raw query
+def probe_query(raw_query, metrics):
+    query = aggregate_query(raw_query["website_id"], [], metrics)
+    query["relative_date"] = raw_query["relative_date"]
+    query["filters"] = copy.deepcopy(raw_query["filters"])
+    return query
+
+
+class AdaptivePoll:
+
+    def __init__(self, raw_query, url_query, metrics, min_interval=0, max_interval=300,
+                 target_rows=20):
+        self.query = probe_query(raw_query, metrics)
+        self.schema = aggregate_schema([], metrics)
+        self.url_query = url_query
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_rows = target_rows
+
+        self.lock = threading.Lock()
+        # numbers of the last refresh that downloaded, of the last probe, and of the probe being downloaded
+        self.signature = None
+        self.probed = None
+        self.candidate = None
+        self.interval = min_interval
+        self.last_poll = None
+        self.next_poll = 0
+        self.probes = 0
+        self.skipped = 0
+        self.rate_limited = 0
+
+    def due(self):
+        return time.monotonic() >= self.next_poll
+
+    # fetch(query, url, schema) like piwik_query. True when today's rows changed since the last refresh
+    def changed(self, fetch):
+        frame = fetch(self.query, self.url_query, schema=self.schema)
+        signature = tuple(frame.iloc[0]) if not frame.empty else ()
+
+        with self.lock:
+            previous, self.probed = self.probed, signature
+            self.candidate = signature
+            self.probes += 1
+
+            # the first number of the probe is a count, its growth is the number of new rows
+            if previous is None:
+                self.interval = self.min_interval
+            elif signature and previous and signature[0] > previous[0]:
+                rows_per_sec = (signature[0] - previous[0]) / max(time.monotonic() - self.last_poll, 1)
+                self.interval = self.target_rows / rows_per_sec
+            else:
+                # nothing arrived, wait longer each time
+                self.interval = max(self.interval * 2, 30)
+
+            self.interval = min(max(self.interval, self.min_interval), self.max_interval)
+            self.last_poll = time.monotonic()
+            self.next_poll = self.last_poll + self.interval
+
+            if signature == self.signature:
+                self.skipped += 1
+                return False
+            return True
+
+    # the rows of the last probe were downloaded and merged
+    def commit(self):
+        with self.lock:
+            if self.candidate is not None:
+                self.signature, self.candidate = self.candidate, None
+
+    def throttled(self, retry_after=None):
+        with self.lock:
+            self.rate_limited += 1
+            self.interval = min(max(self.interval * 2, retry_after or 0, 30), self.max_interval)
+            self.next_poll = time.monotonic() + max(self.interval, retry_after or 0)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "probes": self.probes,
+                "skipped": self.skipped,
+                "rate limited": self.rate_limited,
+                "interval secs": round(self.interval),
+            }
@@ -0,0 +1,48 @@
+import time
+import threading
+import concurrent.futures
+
+# Background data loads for the auto refreshing panels ---------------------------------
+#
+# each panel is a streamlit fragment that reruns on its own timer. the panels ask the scheduler
+# for the data they need: a load is only started again once its last result is older than the
+# panel's refresh interval, so panels refreshing together share one request. loads run on a
+# process wide thread pool instead of holding the streamlit script thread. loads mostly wait on
+# Piwik PRO, the number of requests in flight is bounded per domain (see piwik_sites), not here.
+
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=32, thread_name_prefix="piwik-refresh")
+
+
+class RefreshScheduler:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.started = {}
+        # name: (secs the last load took, time.time() it finished)
+        self.timings = {}
+
+    def timed(self, name, load):
+        start = time.perf_counter()
+        data = load()
+        self.timings[name] = (time.perf_counter() - start, time.time())
+        return data
+
+    def is_due(self, name, max_age):
+        future = self.futures.get(name)
+        if future is None:
+            return True
+        if not future.done():
+            return False
+        # failed loads are retried on the next request
+        if future.exception() is not None:
+            return True
+        return time.monotonic() - self.started[name] >= max_age
+
+    # returns the future of the latest load of name, starting a new one when it is due
+    def request(self, name, load, max_age):
+        with self.lock:
+            if self.is_due(name, max_age):
+                self.started[name] = time.monotonic()
+                self.futures[name] = executor.submit(self.timed, name, load)
+            return self.futures[name]
@@ -0,0 +1,81 @@
+import os
+import re
+import threading
+import pandas as pd
+
+# Several websites under one Piwik PRO domain ---------------------------------
+#
+# the dashboard can watch a list of websites. every site is loaded on its own background load, so
+# the sites are fetched at the same time, and all of them send their requests through one limit per
+# domain and client: watching 30 sites takes about as long as the slowest one, without opening more
+# than REQUEST_LIMIT requests against Piwik PRO at once. the limit is a server setting: viewers of
+# the same account share it, one of them cannot raise or lower it for the others.
+
+
+# a domain is the account's subdomain of piwik.pro and a website id a UUID. both are typed in the
+# sidebar and end up in request urls and in the file paths of the stores, anything else is rejected
+DOMAIN_PATTERN = re.compile(r"[a-z0-9-]+")
+WEBSITE_ID_PATTERN = re.compile(r"[A-Za-z0-9-]+")
+
+
+def valid_domain(piwik_domain):
+    return DOMAIN_PATTERN.fullmatch(piwik_domain) is not None
+
+
+def valid_website_id(website_id):
+    return WEBSITE_ID_PATTERN.fullmatch(website_id) is not None
+
+
+# directory of a website under a store's directory, ValueError for a domain or id that could leave it
+def website_directory(directory, piwik_domain, website_id):
+    if not valid_domain(piwik_domain) or not valid_website_id(website_id):
+        raise ValueError(f"not a Piwik PRO domain and website id: {piwik_domain!r}, {website_id!r}")
+    return os.path.join(directory, piwik_domain, website_id)
+
+
+# website ids separated by commas, spaces or new lines, duplicates removed. ValueError for an id
+# that is not one
+def parse_website_ids(text):
+    ids = []
+    for website_id in re.split(r"[\s,;]+", text.strip()):
+        if not website_id or website_id in ids:
+            continue
+        if not valid_website_id(website_id):
+            raise ValueError(f"{website_id!r} is not a website id")
+        ids.append(website_id)
+    return ids
+
+
+REQUEST_LIMIT = int(os.environ.get("PIWIK_REQUEST_LIMIT", 8))
+
+request_limits = {}
+request_limits_lock = threading.Lock()
+
+
+# semaphore shared by every request of a domain and client
+def get_request_limit(piwik_domain, client_id):
+    key = (piwik_domain, client_id)
+    with request_limits_lock:
+        if key not in request_limits:
+            request_limits[key] = threading.BoundedSemaphore(REQUEST_LIMIT)
+        return request_limits[key]
+
+
+# one overview row per site from its live window and today's aggregated session totals
+def overview_row(website_id, live_sessions, live_events, totals):
+    return {
+        "website_id": website_id,
+        "live sessions": live_sessions["sessions"],
+        "live orders": live_sessions["orders"],
+        "live revenue": live_events["revenue"],
+        "today's sessions": totals.get("sessions"),
+        "today's orders": totals.get("orders"),
+        "today's revenue": totals.get("revenue"),
+    }
+
+
+def overview_frame(rows):
+    columns = ["website_id", "live sessions", "live orders", "live revenue",
+               "today's sessions", "today's orders", "today's revenue", "error"]
+    return pd.DataFrame(rows, columns=columns).sort_values(
+        "live sessions", ascending=False, ignore_index=True)
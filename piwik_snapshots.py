@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import shutil
+import datetime
+import threading
+import pandas as pd
+
+from piwik_aggregate import aggregate_query, aggregate_schema
+from piwik_sites import website_directory
+
+# snapshots are Arrow IPC files. pyarrow is in requirements.txt, a process without it can still run
+# the dashboard without fetch workers
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# Snapshots published by a fetch worker ---------------------------------
+#
+# a worker process (piwik_collector.py --sink arrow) owns the polling of a website: it fetches,
+# aggregates and writes every poll's numbers and tables as a new version directory, one Arrow IPC
+# file per table plus the scalars in meta.json, then points LATEST at it. the dashboard, started with
+# PIWIK_SNAPSHOT_DIR, memory-maps the latest version instead of fetching and computing anything
+# itself: tables are read zero-copy off the page cache, shared by every viewer and every dashboard
+# process on the machine. a version is complete before LATEST names it, so readers never see half
+# of one. the last `keep` versions are kept for readers still holding an older one.
+
+SNAPSHOT_DIRECTORY = os.environ.get("PIWIK_SNAPSHOT_DIR")
+
+
+def write_frame(frame, path):
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    with pa.OSFile(path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+# the frame's columns stay arrow buffers over the mapped file (pandas ArrowDtype), nothing is copied
+def read_frame(path):
+    with pa.memory_map(path) as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+
+class Snapshot:
+
+    def __init__(self, version, directory):
+        self.version = version
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        self.time = datetime.datetime.fromisoformat(meta["time"])
+        self.values = self.load(meta["values"], directory)
+
+    # {"frame": file} placeholders in meta.json are replaced by their mapped tables
+    def load(self, value, directory):
+        if isinstance(value, dict):
+            if set(value) == {"frame"}:
+                return read_frame(os.path.join(directory, value["frame"]))
+            return {k: self.load(v, directory) for k, v in value.items()}
+        return value
+
+
+class SnapshotStore:
+
+    def __init__(self, directory, keep=3):
+        if pa is None:
+            raise ImportError("snapshots need pyarrow: pip install pyarrow")
+        self.directory = directory
+        self.keep = keep
+        self.lock = threading.Lock()
+        # (piwik_domain, website_id): latest Snapshot read by this process
+        self.snapshots = {}
+
+    def website_directory(self, piwik_domain, website_id):
+        return website_directory(self.directory, piwik_domain, website_id)
+
+    def latest_version(self, piwik_domain, website_id):
+        try:
+            with open(os.path.join(self.website_directory(piwik_domain, website_id), "LATEST")) as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return None
+
+    # values: nested dicts of JSON values and DataFrames, frames are written as Arrow files
+    def publish(self, piwik_domain, website_id, time, values):
+        website_directory = self.website_directory(piwik_domain, website_id)
+        version = (self.latest_version(piwik_domain, website_id) or 0) + 1
+        staging = os.path.join(website_directory, f".{version}")
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+
+        frames = []
+
+        def placeholders(value):
+            if isinstance(value, pd.DataFrame):
+                name = f"{len(frames)}.arrow"
+                frames.append(name)
+                write_frame(value, os.path.join(staging, name))
+                return {"frame": name}
+            if isinstance(value, dict):
+                return {k: placeholders(v) for k, v in value.items()}
+            return value
+
+        meta = {"time": time, "values": placeholders(values)}
+        with open(os.path.join(staging, "meta.json"), "w") as f:
+            # numpy scalars of the aggregations as plain numbers
+            json.dump(meta, f, default=lambda value: value.item())
+
+        os.rename(staging, os.path.join(website_directory, str(version)))
+        latest = os.path.join(website_directory, "LATEST.tmp")
+        with open(latest, "w") as f:
+            f.write(str(version))
+        os.replace(latest, os.path.join(website_directory, "LATEST"))
+
+        # a reader may still map a deleted version: its files stay readable until it lets go of them
+        for old in os.listdir(website_directory):
+            if old.isdigit() and int(old) <= version - self.keep:
+                shutil.rmtree(os.path.join(website_directory, old), ignore_errors=True)
+        return version
+
+    # latest published Snapshot of a website, None before the worker's first poll
+    def latest(self, piwik_domain, website_id):
+        version = self.latest_version(piwik_domain, website_id)
+        if version is None:
+            return None
+
+        key = (piwik_domain, website_id)
+        with self.lock:
+            snapshot = self.snapshots.get(key)
+            if snapshot is None or snapshot.version != version:
+                snapshot = Snapshot(version, os.path.join(self.website_directory(*key), str(version)))
+                self.snapshots[key] = snapshot
+            return snapshot
+
+
+# live windows of a website's latest snapshot, in place of SessionBuckets / EventBuckets for the panels
+class SnapshotWindow:
+
+    def __init__(self, store, piwik_domain, website_id):
+        self.store = store
+        self.piwik_domain = piwik_domain
+        self.website_id = website_id
+
+    def window(self, now, minutes):
+        snapshot = self.store.latest(self.piwik_domain, self.website_id)
+        if snapshot is None:
+            raise ValueError(f"no snapshot of website {self.website_id} yet, is its fetch worker running?")
+        live = snapshot.values["live"]
+        if f"{minutes} mins" not in live:
+            published = " ".join(window.split()[0] for window in live)
+            raise ValueError(f"the fetch worker does not publish a {minutes} mins window, "
+                             f"start it with --live-minutes {published} {minutes}")
+        return live[f"{minutes} mins"]
+
+    # the worker counts distinct visitors exactly
+    def error(self):
+        return 0.0
+
+
+# a snapshot holds what the worker fetched with its own credentials. before a viewer is served one,
+# a one row aggregated query for that website with the viewer's token checks their account can read
+# it. a passed check is kept per client and website for ttl secs, a failed one is tried again.
+
+ACCESS_METRICS = [("sessions", "session_id", "unique_count")]
+
+
+class SnapshotAccess:
+
+    def __init__(self, ttl=600):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # (piwik_domain, client_id, website_id): monotonic time of the last passed check
+        self.passed = {}
+        # one check per key at a time, the panels loading together wait for it
+        self.key_locks = {}
+
+    # fetch(query, url, schema) like piwik_query with the viewer's token, raises when it is refused
+    def check(self, fetch, url, piwik_domain, client_id, website_id):
+        key = (piwik_domain, client_id, website_id)
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self.lock:
+                passed = self.passed.get(key)
+            if passed is not None and time.monotonic() - passed < self.ttl:
+                return
+            fetch(aggregate_query(website_id, [], ACCESS_METRICS, limit=1), url,
+                  schema=aggregate_schema([], ACCESS_METRICS))
+            with self.lock:
+                self.passed[key] = time.monotonic()
+
+
+snapshot_store = SnapshotStore(SNAPSHOT_DIRECTORY) if SNAPSHOT_DIRECTORY else None
+snapshot_access = SnapshotAccess()
@@ -0,0 +1,105 @@
+import os
+import sqlite3
+import datetime
+import threading
+import pandas as pd
+
+from piwik_ingest import apply_types
+from piwik_sites import website_directory
+
+# Persistent day store ---------------------------------
+#
+# raw session and event rows are written to one SQLite file per website and day as they are
+# fetched, so a restart or a new process reloads the day from disk and only asks Piwik PRO for
+# rows after the stored high-water mark. each table also keeps the start of the time range it
+# holds without gaps ("covered since"), a query that needs older rows than that fetches normally.
+# files older than retention_days are deleted.
+
+STORE_DIRECTORY = "piwik_store"
+
+
+def sql_value(value):
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    if hasattr(value, "item"):
+        return value.item()
+    return value
+
+
+class DayStore:
+
+    def __init__(self, directory=STORE_DIRECTORY, retention_days=7):
+        self.directory = directory
+        self.retention_days = retention_days
+        self.lock = threading.Lock()
+
+    def path(self, piwik_domain, website_id, day):
+        return os.path.join(website_directory(self.directory, piwik_domain, website_id), f"{day.isoformat()}.sqlite")
+
+    def connect(self, piwik_domain, website_id, day):
+        path = self.path(piwik_domain, website_id, day)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        con = sqlite3.connect(path)
+        con.execute("CREATE TABLE IF NOT EXISTS coverage (name TEXT PRIMARY KEY, since TEXT)")
+        return con
+
+    # returns the stored rows of table and the time they are complete since, or (None, None)
+    def load(self, piwik_domain, website_id, day, table, types):
+        if not os.path.exists(self.path(piwik_domain, website_id, day)):
+            return None, None
+
+        with self.lock:
+            con = self.connect(piwik_domain, website_id, day)
+            try:
+                covered = con.execute(
+                    "SELECT since FROM coverage WHERE name = ?", (table,)).fetchone()
+                if covered is None:
+                    return None, None
+                stored = pd.read_sql_query(f'SELECT * FROM "{table}"', con)
+            finally:
+                con.close()
+
+        return apply_types(stored, types), datetime.datetime.fromisoformat(covered[0])
+
+    # upserts rows into table (keyed on key_columns) and records the time it is complete since
+    def save(self, piwik_domain, website_id, day, table, key_columns, rows, covered_since):
+        columns = list(rows.columns)
+        column_list = ", ".join(f'"{c}"' for c in columns)
+
+        with self.lock:
+            con = self.connect(piwik_domain, website_id, day)
+            try:
+                with con:
+                    con.execute(
+                        f'CREATE TABLE IF NOT EXISTS "{table}" ({column_list}, '
+                        f'PRIMARY KEY ({", ".join(key_columns)}))')
+                    con.executemany(
+                        f'INSERT OR REPLACE INTO "{table}" ({column_list}) '
+                        f'VALUES ({", ".join("?" for _ in columns)})',
+                        ([sql_value(v) for v in row]
+                         for row in rows.astype("object").itertuples(index=False)))
+                    con.execute("INSERT OR REPLACE INTO coverage (name, since) VALUES (?, ?)",
+                                (table, covered_since.isoformat()))
+            finally:
+                con.close()
+
+    # deletes the day files older than the retention policy
+    def prune(self, today):
+        oldest = today - datetime.timedelta(days=self.retention_days)
+
+        for root, dirs, files in os.walk(self.directory):
+            for file in files:
+                if not file.endswith(".sqlite"):
+                    continue
+                try:
+                    day = datetime.date.fromisoformat(file[:-len(".sqlite")])
+                except ValueError:
+                    continue
+                if day < oldest:
+                    os.remove(os.path.join(root, file))
+
+
+day_store = DayStore()
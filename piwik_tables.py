@@ -0,0 +1,42 @@
+import io
+import math
+import pandas as pd
+
+# Large dimension tables, one page at a time ---------------------------------
+#
+# the url, keyword and source tables of a big site run to tens of thousands of rows. the panels only
+# send the browser the page being looked at: the rows matching the search are ranked with a partial
+# selection (nlargest up to the end of the page) instead of sorting the whole table on every refresh.
+# the whole table is exported as CSV or Parquet when asked for.
+
+PAGE_SIZE = 50
+
+
+# rows with the text in any of their dimension columns, case insensitive
+def search_rows(table, text):
+    if not text:
+        return table
+    found = pd.Series(False, index=table.index)
+    for column in table.select_dtypes(exclude="number").columns:
+        found |= table[column].astype("string").str.contains(text, case=False, regex=False, na=False)
+    return table[found]
+
+
+def page_count(table, page_size=PAGE_SIZE):
+    return max(1, math.ceil(len(table) / page_size))
+
+
+# rows of page (from 0) ranked by value_column, largest first
+def page_rows(table, value_column, page, page_size=PAGE_SIZE):
+    end = (page + 1) * page_size
+    return table.nlargest(end, value_column).iloc[page * page_size:end]
+
+
+def export_csv(table):
+    return table.to_csv(index=False).encode()
+
+
+def export_parquet(table):
+    buffer = io.BytesIO()
+    table.to_parquet(buffer, index=False)
+    return buffer.getvalue()
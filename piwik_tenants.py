@@ -0,0 +1,117 @@
+import os
+import time
+import threading
+import collections
+import pandas as pd
+
+from piwik_cache import poll_cache
+
+# Per tenant data with a memory budget ---------------------------------
+#
+# a tenant is a Piwik PRO domain and client id. every tenant's loaded data (today's rows of each
+# website, see piwik_incremental) is kept here instead of in one unbounded process wide cache.
+# an entry is measured after each of its loads and the least recently used ones are evicted: first the
+# tenant's own when it is over its share (tenant_budget), then anyone's when the process is over the
+# total budget. entries used in the last active_secs are kept: someone is viewing them, their panels
+# still hold them and evicting them would free nothing. an evicted website is loaded again from the
+# day store the next time it is viewed, its shared poll results (see attach) are dropped with it.
+# entries not used for idle_ttl secs are dropped.
+
+MEMORY_BUDGET_MB = int(os.environ.get("PIWIK_MEMORY_BUDGET_MB", 1024))
+TENANT_BUDGET_MB = int(os.environ.get("PIWIK_TENANT_BUDGET_MB", 256))
+
+
+# bytes held by a cached value: its own nbytes() when it has one, else a DataFrame's deep size
+def measured_bytes(value):
+    if callable(getattr(value, "nbytes", None)):
+        return value.nbytes()
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    return 0
+
+
+class TenantCache:
+
+    def __init__(self, budget_mb=MEMORY_BUDGET_MB, tenant_budget_mb=TENANT_BUDGET_MB, idle_ttl=3600*12,
+                 active_secs=300):
+        self.budget = budget_mb * 1024**2
+        self.tenant_budget = tenant_budget_mb * 1024**2
+        self.idle_ttl = idle_ttl
+        self.active_secs = active_secs
+
+        self.lock = threading.Lock()
+        # (tenant, key): {"value", "bytes", "used"}, least recently used first
+        self.entries = collections.OrderedDict()
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+    # value cached for tenant and key, create() builds it when there is none
+    def get(self, tenant, key, create):
+        with self.lock:
+            entry = self.entries.get((tenant, key))
+            if entry is None:
+                entry = {"value": create(), "bytes": 0, "poll_keys": set()}
+                self.entries[(tenant, key)] = entry
+            self.entries.move_to_end((tenant, key))
+            entry["used"] = time.monotonic()
+            return entry["value"]
+
+    # poll_cache key whose results hold the rows of a cached value, forgotten when the value is evicted
+    def attach(self, tenant, value, poll_key):
+        with self.lock:
+            for (entry_tenant, _), entry in self.entries.items():
+                if entry_tenant == tenant and entry["value"] is value:
+                    entry["poll_keys"].add(poll_key)
+
+    # measures the tenant's entry holding value again after a load grew it, the other entries keep
+    # their recorded sizes, and evicts until the budgets hold
+    def account(self, tenant=None, value=None):
+        with self.lock:
+            now = time.monotonic()
+            for entry_key, entry in list(self.entries.items()):
+                if now - entry["used"] > self.idle_ttl:
+                    self.evict(entry_key)
+                elif value is not None and entry_key[0] == tenant and entry["value"] is value:
+                    entry["bytes"] = measured_bytes(value)
+
+            tenant_bytes = collections.Counter()
+            for (tenant, _), entry in self.entries.items():
+                tenant_bytes[tenant] += entry["bytes"]
+
+            kept = {entry_key for entry_key, entry in self.entries.items()
+                    if now - entry["used"] <= self.active_secs}
+
+            for entry_key, entry in list(self.entries.items()):
+                tenant = entry_key[0]
+                if tenant_bytes[tenant] > self.tenant_budget and entry_key not in kept:
+                    tenant_bytes[tenant] -= entry["bytes"]
+                    self.evict(entry_key)
+
+            total = sum(tenant_bytes.values())
+            for entry_key, entry in list(self.entries.items()):
+                if total <= self.budget:
+                    break
+                if entry_key not in kept:
+                    total -= entry["bytes"]
+                    self.evict(entry_key)
+
+    def evict(self, entry_key):
+        entry = self.entries.pop(entry_key)
+        self.evictions += 1
+        self.evicted_bytes += entry["bytes"]
+        # the shared poll results of this value hold the same rows
+        poll_cache.forget(entry["poll_keys"])
+
+    def stats(self, tenant=None):
+        with self.lock:
+            return {
+                "Accounts": len({t for t, _ in self.entries}),
+                "Memory MB": round(sum(e["bytes"] for e in self.entries.values()) / 1024**2, 1),
+                "Budget MB": round(self.budget / 1024**2),
+                "This account MB": round(
+                    sum(e["bytes"] for (t, _), e in self.entries.items() if t == tenant) / 1024**2, 1),
+                "Evictions": self.evictions,
+            }
+
+
+tenant_cache = TenantCache()
@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import threading
+import functools
+import contextlib
+import collections
+import tracemalloc
+
+# Per stage timing of the refreshes ---------------------------------
+#
+# every stage of a refresh (token, HTTP round-trip, JSON decode, frame build, merges, aggregations,
+# panel rendering) is recorded with its wall time, rows, payload bytes and memory. the recorder
+# keeps a summary per stage for the dashboard's performance panel and, when PIWIK_TIMINGS_DIR is
+# set, appends every record to stages.jsonl and rewrites a Prometheus text snapshot (metrics.prom)
+# for the production charts.
+# peak memory is the traced allocation peak during the stage, only when python runs with tracemalloc
+# (PYTHONTRACEMALLOC=1): stages running at the same time share that peak. every stage also records the
+# change of the process' resident memory over it (linux), which is cheap but includes what other
+# threads allocated meanwhile and what the allocator keeps after the stage.
+
+TIMINGS_DIRECTORY = os.environ.get("PIWIK_TIMINGS_DIR")
+
+
+# current resident memory of the process, None where /proc is not available
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class Stage:
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        # set by the code being timed when it knows them
+        self.rows = None
+        self.bytes = None
+
+
+class StageRecorder:
+
+    def __init__(self, directory=TIMINGS_DIRECTORY, history=1000, snapshot_secs=10):
+        self.directory = directory
+        self.snapshot_secs = snapshot_secs
+        self.lock = threading.Lock()
+        self.records = collections.deque(maxlen=history)
+        # (stage, labels): running totals, see summary
+        self.totals = {}
+        self.last_snapshot = 0
+        # functions returning more Prometheus text for the snapshot, e.g. piwik_http's latency histograms
+        self.collectors = []
+
+    @contextlib.contextmanager
+    def stage(self, name, **labels):
+        stage = Stage(name, labels)
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+        rss = rss_bytes()
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            secs = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] if tracing else None
+            rss_change = rss_bytes() - rss if rss is not None else None
+            self.record(stage, secs, peak, rss_change)
+
+    # decorator timing every call of a function as a stage labelled with the function name
+    def timed(self, name):
+        def decorate(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name, function=function.__name__):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def record(self, stage, secs, peak, rss_change=None):
+        record = {
+            "time": round(time.time(), 3),
+            "stage": stage.name,
+            **stage.labels,
+            "secs": round(secs, 6),
+            "rows": stage.rows,
+            "bytes": stage.bytes,
+            "peak_memory_bytes": peak,
+            "rss_change_bytes": rss_change,
+        }
+        key = (stage.name, tuple(sorted(stage.labels.items())))
+
+        with self.lock:
+            self.records.append(record)
+            totals = self.totals.setdefault(key, {
+                "calls": 0, "secs": 0.0, "max_secs": 0.0, "rows": 0, "bytes": 0,
+                "peak_memory_bytes": None, "rss_change_bytes": None})
+            totals["calls"] += 1
+            totals["secs"] += secs
+            totals["max_secs"] = max(totals["max_secs"], secs)
+            totals["last_secs"] = secs
+            totals["rows"] += stage.rows or 0
+            totals["bytes"] += stage.bytes or 0
+            # largest of the runs that measured it
+            for field, value in (("peak_memory_bytes", peak), ("rss_change_bytes", rss_change)):
+                if value is not None:
+                    totals[field] = value if totals[field] is None else max(totals[field], value)
+
+        if self.directory:
+            self.export(record)
+
+    # one row per stage and labels, for the performance panel
+    def summary(self):
+        with self.lock:
+            rows = []
+            for (name, labels), totals in sorted(self.totals.items()):
+                rows.append({
+                    "stage": name,
+                    "labels": ", ".join(str(v) for _, v in labels),
+                    "calls": totals["calls"],
+                    "last secs": round(totals["last_secs"], 4),
+                    "mean secs": round(totals["secs"] / totals["calls"], 4),
+                    "max secs": round(totals["max_secs"], 4),
+                    "rows": totals["rows"],
+                    "MB": round(totals["bytes"] / 1e6, 2),
+                    "peak MB": megabytes(totals["peak_memory_bytes"]),
+                    "max RSS change MB": megabytes(totals["rss_change_bytes"]),
+                })
+            return rows
+
+    def prometheus(self):
+        metrics = [
+            ("piwik_stage_calls_total", "counter", "Stage runs", "calls"),
+            ("piwik_stage_seconds_total", "counter", "Wall time spent in the stage", "secs"),
+            ("piwik_stage_last_seconds", "gauge", "Wall time of the last run", "last_secs"),
+            ("piwik_stage_max_seconds", "gauge", "Slowest run", "max_secs"),
+            ("piwik_stage_rows_total", "counter", "Rows handled", "rows"),
+            ("piwik_stage_bytes_total", "counter", "Payload bytes handled", "bytes"),
+            ("piwik_stage_peak_memory_bytes", "gauge", "Peak traced allocations during the stage", "peak_memory_bytes"),
+            ("piwik_stage_rss_change_bytes", "gauge", "Largest change of resident memory over the stage",
+             "rss_change_bytes"),
+        ]
+        with self.lock:
+            totals = sorted(self.totals.items())
+
+        lines = []
+        for metric, kind, description, field in metrics:
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for (name, labels), values in totals:
+                if values[field] is None:
+                    continue
+                label_text = ",".join(
+                    f'{k}="{str(v).replace(chr(34), chr(39))}"' for k, v in (("stage", name), *labels))
+                lines.append(f"{metric}{{{label_text}}} {values[field]}")
+        return "\n".join(lines) + "\n" + "".join(collect() for collect in self.collectors)
+
+    def export(self, record):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with self.lock:
+                with open(os.path.join(self.directory, "stages.jsonl"), "a") as f:
+                    f.write(json.dumps(record) + "\n")
+                snapshot_due = time.monotonic() - self.last_snapshot >= self.snapshot_secs
+                if snapshot_due:
+                    self.last_snapshot = time.monotonic()
+
+            if snapshot_due:
+                path = os.path.join(self.directory, "metrics.prom")
+                with open(path + ".tmp", "w") as f:
+                    f.write(self.prometheus())
+                os.replace(path + ".tmp", path)
+        except OSError as e:
+            print(f"timings not exported: {e}")
+
+
+def megabytes(value):
+    return None if value is None else round(value / 1e6, 1)
+
+
+recorder = StageRecorder()
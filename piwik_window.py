@@ -0,0 +1,218 @@
+import math
+import threading
+import pandas as pd
+
+from piwik_aggregate import EVENT_TYPE_PAGEVIEW, EVENT_TYPE_SEARCH, conversion_rate
+from piwik_hll import HyperLogLog, hash_values, relative_error, DEFAULT_PRECISION
+
+# Sliding window aggregates from per minute buckets ---------------------------------
+#
+# the live panels used to filter the whole day again on every refresh. instead, every row merged
+# into an IncrementalQuery is added once to the bucket of its minute, in a ring of the last
+# `minutes` minutes. a bucket holds the counts, revenue, per dimension counters and distinct id
+# sets of its minute, so any window up to the ring size is read off the buckets without touching
+# the day's rows. rows fetched again (refresh overlap) replace their earlier version.
+# distinct visitors per url and keyword are exact sets, or HyperLogLog sketches with
+# distinct="hll" (see piwik_hll), which keeps their size and merge cost bounded on busy sites.
+
+NANOSECONDS_PER_MINUTE = 60 * 1000 ** 3
+
+
+def epoch_minute(timestamp):
+    return pd.Timestamp(timestamp).value // NANOSECONDS_PER_MINUTE
+
+
+def is_missing(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+class MinuteRing:
+
+    def __init__(self, minutes, new_bucket):
+        self.minutes = minutes
+        self.new_bucket = new_bucket
+        # one slot more than the longest window, its oldest minute never shares a slot with the newest
+        self.slots = [None] * (minutes + 1)
+        self.lock = threading.Lock()
+
+    # bucket of an epoch minute, None when the ring already moved past it
+    def bucket(self, minute):
+        slot = minute % len(self.slots)
+        entry = self.slots[slot]
+        if entry is None or entry[0] < minute:
+            entry = (minute, self.new_bucket())
+            self.slots[slot] = entry
+        elif entry[0] > minute:
+            return None
+        return entry[1]
+
+    # (minute, bucket) pairs from first_minute to last_minute, oldest first
+    def window(self, first_minute, last_minute):
+        return sorted((entry for entry in self.slots
+                       if entry is not None and first_minute <= entry[0] <= last_minute),
+                      key=lambda entry: entry[0])
+
+    # rows that can still land in the ring, so a full day load only loops over the last minutes
+    def recent_rows(self, rows):
+        if rows.empty:
+            return rows
+        oldest = rows["timestamp"].max() - pd.Timedelta(minutes=self.minutes)
+        return rows.loc[rows["timestamp"] >= oldest]
+
+    # first and last minute of the window: the minute of now and the minutes - 1 before it
+    def window_minutes(self, now, minutes):
+        last_minute = epoch_minute(now)
+        return last_minute - minutes + 1, last_minute
+
+
+class SessionBucket:
+
+    def __init__(self):
+        # session_id: ((source, medium, campaign_name), orders)
+        self.sessions = {}
+        # (source, medium, campaign_name): [sessions, orders]
+        self.sources = {}
+
+    def add(self, session_id, source, orders):
+        previous = self.sessions.get(session_id)
+        if previous is not None:
+            counts = self.sources[previous[0]]
+            counts[0] -= 1
+            counts[1] -= previous[1]
+
+        self.sessions[session_id] = (source, orders)
+        counts = self.sources.setdefault(source, [0, 0])
+        counts[0] += 1
+        counts[1] += orders
+
+
+class SessionBuckets(MinuteRing):
+
+    def __init__(self, minutes=60):
+        super().__init__(minutes, SessionBucket)
+
+    def add(self, session_data):
+        rows = self.recent_rows(session_data)
+        minutes = rows["timestamp"].to_numpy(dtype="datetime64[m]").astype("int64")
+
+        with self.lock:
+            for minute, session_id, source, medium, campaign_name, orders in zip(
+                    minutes, rows["session_id"], rows["source"], rows["medium"],
+                    rows["campaign_name"], rows["session_total_ecommerce_conversions"]):
+                bucket = self.bucket(int(minute))
+                if bucket is not None:
+                    bucket.add(session_id, (source, medium, campaign_name), int(orders))
+
+    def window(self, now, minutes):
+        with self.lock:
+            buckets = super().window(*self.window_minutes(now, minutes))
+
+            sources = {}
+            for _, bucket in buckets:
+                for source, (count, orders) in bucket.sources.items():
+                    if count == 0 or any(is_missing(v) for v in source):
+                        continue
+                    totals = sources.setdefault(source, [0, 0])
+                    totals[0] += count
+                    totals[1] += orders
+
+            per_minute = [(minute, len(bucket.sessions)) for minute, bucket in buckets]
+            orders = sum(counts[1] for _, bucket in buckets for counts in bucket.sources.values())
+
+        df_source = pd.DataFrame(
+            [(*source, count, source_orders) for source, (count, source_orders) in sources.items()],
+            columns=["source", "medium", "campaign_name", "sessions", "orders"])
+        df_source = conversion_rate(df_source)
+
+        # every minute between the first and last one with sessions, like a 1 minute Grouper
+        per_minute = [(m, n) for m, n in per_minute if n > 0]
+        df_minutes = pd.DataFrame(columns=["Time", "Sessions"])
+        if per_minute:
+            counts = dict(per_minute)
+            all_minutes = range(per_minute[0][0], per_minute[-1][0] + 1)
+            df_minutes = pd.DataFrame({
+                "Time": pd.to_datetime([m * NANOSECONDS_PER_MINUTE for m in all_minutes]).strftime('%H:%M'),
+                "Sessions": [counts.get(m, 0) for m in all_minutes],
+            })
+
+        return {
+            "sessions": sum(n for _, n in per_minute),
+            "orders": orders,
+            "sources": df_source,
+            "minutes": df_minutes,
+        }
+
+
+class EventBucket:
+
+    def __init__(self):
+        self.events = set()
+        self.revenue = 0.0
+        # url / keyword: distinct visitor ids (set or HyperLogLog of their hashes)
+        self.pageviews = {}
+        self.searches = {}
+
+
+class EventBuckets(MinuteRing):
+
+    def __init__(self, minutes=60, distinct="exact", precision=DEFAULT_PRECISION):
+        super().__init__(minutes, EventBucket)
+        self.distinct = distinct
+        self.precision = precision
+
+    def new_distinct(self):
+        if self.distinct == "hll":
+            return HyperLogLog(self.precision)
+        return set()
+
+    # relative standard error of the distinct counts, 0 when they are exact
+    def error(self):
+        return relative_error(self.precision) if self.distinct == "hll" else 0.0
+
+    def add(self, event_data):
+        rows = self.recent_rows(event_data)
+        minutes = rows["timestamp"].to_numpy(dtype="datetime64[m]").astype("int64")
+        visitors = hash_values(rows["visitor_id"]) if self.distinct == "hll" else rows["visitor_id"]
+
+        with self.lock:
+            for minute, session_id, event_id, visitor_id, event_type_id, url, keyword, revenue in zip(
+                    minutes, rows["session_id"], rows["event_id"], visitors,
+                    rows["event_type_id"], rows["event_url"], rows["search_keyword"], rows["revenue"]):
+                bucket = self.bucket(int(minute))
+                if bucket is None or (session_id, event_id) in bucket.events:
+                    continue
+                bucket.events.add((session_id, event_id))
+
+                if not is_missing(revenue):
+                    bucket.revenue += float(revenue)
+                if event_type_id == EVENT_TYPE_PAGEVIEW and not is_missing(url):
+                    bucket.pageviews.setdefault(url, self.new_distinct()).add(visitor_id)
+                elif event_type_id == EVENT_TYPE_SEARCH and not is_missing(keyword):
+                    bucket.searches.setdefault(keyword, self.new_distinct()).add(visitor_id)
+
+    def window(self, now, minutes):
+        with self.lock:
+            buckets = super().window(*self.window_minutes(now, minutes))
+
+            revenue = sum(bucket.revenue for _, bucket in buckets)
+            pageviews, searches = {}, {}
+            for _, bucket in buckets:
+                for url, visitors in bucket.pageviews.items():
+                    pageviews.setdefault(url, self.new_distinct()).update(visitors)
+                for keyword, visitors in bucket.searches.items():
+                    searches.setdefault(keyword, self.new_distinct()).update(visitors)
+
+        df_pageviews = pd.DataFrame(
+            [(url, len(visitors)) for url, visitors in pageviews.items()],
+            columns=["url", "pageviews"])
+        df_searches = pd.DataFrame(
+            [(keyword, len(visitors)) for keyword, visitors in searches.items()],
+            columns=["search_keyword", "unique_searches"])
+
+        return {
+            "revenue": round(revenue, 2),
+            "pageviews": int(df_pageviews["pageviews"].sum()),
+            "pageviews_table": df_pageviews,
+            "searches": int(df_searches["unique_searches"].sum()),
+            "searches_table": df_searches,
+        }
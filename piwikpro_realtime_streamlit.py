@@ -1,11 +1,41 @@
-import requests
-import json
 import pandas as pd
 import datetime
-import re
-import time
+import functools
 import streamlit as st
-from streamlit_javascript import st_javascript
+
+from piwik_api import (api_urls, piwik_query, raw_session_query, raw_event_query,
+                       SESSION_BASE_COLUMNS, EVENT_BASE_COLUMNS)
+from piwik_auth import get_token_manager
+from piwik_incremental import IncrementalQuery, SESSION_OVERLAP_MINUTES
+from piwik_ingest import bytes_per_row
+from piwik_aggregate import aggregate_totals, compare_totals, TOTAL_SECTIONS
+from piwik_metrics import raw_totals
+from piwik_refresh import RefreshScheduler
+from piwik_cache import poll_cache, cache_key
+from piwik_store import day_store
+from piwik_window import SessionBuckets, EventBuckets
+from piwik_timing import recorder
+from piwik_sites import parse_website_ids, valid_domain, get_request_limit, overview_row, overview_frame
+from piwik_poll import AdaptivePoll, PROBE_METRICS
+from piwik_http import http
+from piwik_tenants import tenant_cache
+from piwik_snapshots import snapshot_store, snapshot_access, SnapshotWindow
+from piwik_tables import search_rows, page_count, page_rows, export_csv, export_parquet
+from piwik_history import history_store, COMPARISONS, SETTLE_HOURS
+
+# live windows offered in the sidebar, all read off the same per minute buckets
+LIVE_WINDOWS = [5, 15, 30, 60]
+
+# panel: (label, the refresh input it follows by default)
+PANELS = {
+    "live_traffic": ("Live traffic", "live_refresh"),
+    "live_pageviews": ("Live pageviews", "live_refresh"),
+    "live_searches": ("Live searches", "live_refresh"),
+    "total_traffic": ("Today's traffic", "totals_refresh"),
+    "total_pageviews": ("Today's pageviews", "totals_refresh"),
+    "total_searches": ("Today's searches", "totals_refresh"),
+}
+MIN_REFRESH = {"live_refresh": 30, "totals_refresh": 60}
 
 # STREAMLIT data visualization ----------------------
 
@@ -21,18 +51,24 @@ st.title(f"PiwikPro Realtime Analytics")
 st.sidebar.subheader(
     "Please insert your Piwik Pro website/app and API key details and data requests.")
 
-# user input with cache functionality to not lose credentials. it is reset in 3 hours to not break streamlit memory
-@st.cache_resource(ttl=3600*12)
+# user input of this browser session only, credentials are never shared with other viewers
 def get_user_input():
-    return {
+    return st.session_state.setdefault("user_input", {
         "piwik_domain": "",
         "website_id": "",
         "client_id": "",
         "client_secret": "",
         "total_sessions":"",
         "total_pageviews":"",
-        "total_searches":""
-    }
+        "total_searches":"",
+        "totals_source":"",
+        "live_refresh":"",
+        "totals_refresh":"",
+        "panel_refresh":{},
+        "live_minutes":"",
+        "live_distinct":"",
+        "compare_with":""
+    })
 
 
 user_input = get_user_input()
@@ -42,11 +78,41 @@ user_input["total_sessions"]=st.sidebar.checkbox("Total Daily Sessions?")
 user_input["total_pageviews"]=st.sidebar.checkbox("Total Daily Pageviews?")
 user_input["total_searches"]=st.sidebar.checkbox("Total Daily Searches?")
 
+# aggregated totals are grouped by Piwik PRO, only the live window is downloaded as raw rows.
+# with fetch workers the worker computes them (its --raw-totals flag)
+if snapshot_store is None:
+    user_input["totals_source"]=st.sidebar.radio(
+        "Today's totals from", ["Aggregated query", "Raw data", "Compare both"])
+else:
+    user_input["totals_source"]="Aggregated query"
+
+# each panel refreshes on its own in the page, without reloading the browser. the live panels only
+# download the live window, so they can refresh much more often than today's totals
+user_input["live_refresh"]=st.sidebar.number_input(
+    "Live panels refresh (secs)", min_value=MIN_REFRESH["live_refresh"], value=60, step=30)
+user_input["totals_refresh"]=st.sidebar.number_input(
+    "Today's totals refresh (secs)", min_value=MIN_REFRESH["totals_refresh"], value=600, step=60)
+with st.sidebar.expander("Refresh per panel (secs)"):
+    user_input["panel_refresh"] = {
+        panel: st.number_input(label, min_value=MIN_REFRESH[tier], value=user_input[tier], step=30)
+        for panel, (label, tier) in PANELS.items()}
+user_input["live_minutes"]=st.sidebar.selectbox(
+    "Live window (mins)", LIVE_WINDOWS, index=LIVE_WINDOWS.index(30))
+# sketches keep live distinct visitor counts cheap on big sites, exact counts suit small ones
+user_input["live_distinct"]=st.sidebar.radio(
+    "Live distinct visitors", ["Exact", "HyperLogLog"], horizontal=True)
+# the live numbers against the same window of an earlier day, each past day is downloaded only once
+if snapshot_store is None:
+    user_input["compare_with"]=st.sidebar.radio(
+        "Compare live numbers with", [*COMPARISONS, "Nothing"])
+else:
+    user_input["compare_with"]="Nothing"
+
 
 user_input["piwik_domain"] = st.sidebar.text_input(
     "Piwik Domain (from domain.piwik.pro)", user_input["piwik_domain"])
 user_input["website_id"] = st.sidebar.text_input(
-    "Website id", user_input["website_id"])
+    "Website id(s)", user_input["website_id"], help="Several ids separated by commas show an overview of all the sites.")
 user_input["client_id"] = st.sidebar.text_input(
     "Client ID", user_input["client_id"])
 
@@ -54,7 +120,7 @@ user_input["client_secret"] = st.sidebar.text_input(
     "Client Secret", user_input["client_secret"], type="password")
 
 st.sidebar.markdown(
-    "Piwik Pro's API allow us to access its raw session and event metrics in near real time. Official PiwikPro instructions for getting [Website Id](https://help.piwik.pro/support/questions/find-website-id/) and [Client Id / Secret](https://developers.piwik.pro/en/latest/platform/getting_started.html). Cache, refresh rate and options are limited in order to not break Streamlit's memory.", unsafe_allow_html=True)
+    "Piwik Pro's API allow us to access its raw session and event metrics in near real time. Official PiwikPro instructions for getting [Website Id](https://help.piwik.pro/support/questions/find-website-id/) and [Client Id / Secret](https://developers.piwik.pro/en/latest/platform/getting_started.html). Loaded data is kept within a memory budget per account, the least recently viewed websites are dropped first.", unsafe_allow_html=True)
 
 st.sidebar.text("Created by João Valente. Enjoy!")
 st.sidebar.markdown(
@@ -99,446 +165,597 @@ h2 {
     unsafe_allow_html=True,
 )
 
-# authentication token on Piwik PRO API ---------------------------------
-
-
-def piwik_token(domain, url, id, secret):
-    creds = {
-        "grant_type": "client_credentials",
-        "client_id": id,
-        "client_secret": secret
-    }
-    token_data = requests.post(url, data=creds, headers={
-                               'Accept': 'application/json'}, json={"key": "value"}).json()
-
-    token = token_data['access_token']
-    token_headers = {"Authorization": "Bearer " +
-                     token,  "Accept-Encoding": "gzip"}
-
-    return(token_headers)
+# the domain and website ids go into request urls and file paths, unexpected values are rejected
+piwik_domain = user_input["piwik_domain"].strip().lower()
+try:
+    website_ids = parse_website_ids(user_input["website_id"])
+    input_error = None if not piwik_domain or valid_domain(piwik_domain) else \
+        f"{piwik_domain!r} is not a Piwik PRO domain, use the name before .piwik.pro"
+except ValueError as e:
+    website_ids, input_error = [], f"{e}, website ids are listed in the Piwik PRO administration"
 
+if input_error:
+    st.warning(f"Please correct the sidebar input: {input_error}.")
 
 # Add this code to display a message when input values are not provided
-if not user_input["piwik_domain"] or not user_input["client_id"] or not user_input["client_secret"] or not user_input["website_id"]:
+# website ids like "," parse to no id at all
+elif not piwik_domain or not user_input["client_id"] or not user_input["client_secret"] or not website_ids:
     st.warning("Please provide the required input values in the sidebar.")
 
 
 else:
-    piwik_domain = user_input["piwik_domain"]
-    token_url = f'https://{piwik_domain}.piwik.pro/auth/token'
+    piwik_urls = api_urls(piwik_domain)
     client_id = user_input["client_id"]
     client_secret = user_input["client_secret"]
 
-    piwik_headers = piwik_token(token_url, token_url, client_id, client_secret)
-
-    print("token generated")
+    # the token is shared by reruns and viewers and only renewed shortly before it expires
+    piwik_tokens = get_token_manager(piwik_domain, client_id, client_secret)
+
+    # website ids from user input. with several sites the overview comes first and one site is
+    # picked for the detailed panels
+    sites_overview = st.container()
+    if len(website_ids) > 1:
+        website_id = st.selectbox("Site details", website_ids)
+    else:
+        website_id = website_ids[0]
+
+    query_url = piwik_urls["query"]
+    session_query_url = piwik_urls["sessions"]
+    event_query_url = piwik_urls["events"]
+
+    # every request of every site and viewer waits for a free slot of the account's limit
+    request_limit = get_request_limit(piwik_domain, client_id)
+
+    def fetch(query, url_query, schema=None):
+        with request_limit:
+            return piwik_query(query, url_query, piwik_tokens, schema)
+
+    # today's data is kept between refreshes so only new rows are downloaded. it is shared by every
+    # viewer of the website, refreshes go through poll_cache so only one of them fetches at a time.
+    # rows are also kept in the day store, a restarted server reloads them instead of refetching the day.
+    # new rows also update per minute buckets of the last hour, the live panels read their window off them.
+    # a cheap probe skips the download when nothing changed, quiet sites are probed less often.
+    # queries are kept per account (domain and client id) within its memory budget, see piwik_tenants
+    tenant = (piwik_domain, client_id)
+
+    def incremental_query(piwik_domain, client_id, website_id, name, window_minutes=None, distinct="exact"):
+        return tenant_cache.get(
+            (piwik_domain, client_id), (website_id, name, window_minutes, distinct),
+            lambda: new_incremental_query(piwik_domain, website_id, name, window_minutes, distinct))
+
+    # a live window query keeps the per minute buckets and its own day store table: its rows only
+    # cover the window, they must not mark the whole day table as covered from there on
+    def new_incremental_query(piwik_domain, website_id, name, window_minutes, distinct):
+        live = window_minutes is not None
+        table = f"{name} live" if live else name
+        if name == "sessions":
+            query = raw_session_query(website_id)
+            return IncrementalQuery(
+                query, session_query_url,
+                SESSION_BASE_COLUMNS, ["session_id"], overlap_minutes=SESSION_OVERLAP_MINUTES,
+                window_minutes=window_minutes,
+                store=day_store, store_key=(piwik_domain, website_id, table),
+                buckets=SessionBuckets(max(LIVE_WINDOWS)) if live else None,
+                poll=AdaptivePoll(query, query_url, PROBE_METRICS[name]))
+        query = raw_event_query(website_id)
+        return IncrementalQuery(
+            query, event_query_url,
+            EVENT_BASE_COLUMNS, ["session_id", "event_id"], window_minutes=window_minutes,
+            store=day_store, store_key=(piwik_domain, website_id, table),
+            buckets=EventBuckets(max(LIVE_WINDOWS), distinct) if live else None,
+            poll=AdaptivePoll(query, query_url, PROBE_METRICS[name]))
+
+    total_sections = [s for s in TOTAL_SECTIONS if user_input[s]]
+    raw_totals_needed = user_input["totals_source"] != "Aggregated query" and bool(total_sections)
+    aggregated_totals = user_input["totals_source"] != "Raw data" and total_sections
+
+    live_distinct = "hll" if user_input["live_distinct"] == "HyperLogLog" else "exact"
+
+    # two tiers refreshing independently: the live panels read a small query of the live window only,
+    # filtered by Piwik PRO to the last max(LIVE_WINDOWS) minutes. the whole day is only downloaded
+    # for totals computed from raw data, on the totals' slower cadence
+    live_window = max(LIVE_WINDOWS)
+
+    # with fetch workers running (piwik_collector.py --sink arrow, see piwik_snapshots) the panels read
+    # the worker's latest snapshot and this process queries nothing itself
+    use_snapshots = snapshot_store is not None
+    if use_snapshots:
+        live_session_query = live_event_query = None
+        session_buckets = event_buckets = SnapshotWindow(snapshot_store, piwik_domain, website_id)
+    else:
+        live_session_query = incremental_query(piwik_domain, client_id, website_id, "sessions", live_window)
+        live_event_query = incremental_query(piwik_domain, client_id, website_id, "events", live_window, live_distinct)
+        session_buckets = live_session_query.buckets
+        event_buckets = live_event_query.buckets
+
+    session_query = event_query = None
+    if raw_totals_needed:
+        session_query = incremental_query(piwik_domain, client_id, website_id, "sessions")
+        event_query = incremental_query(piwik_domain, client_id, website_id, "events")
 
-    headers_timestamp = datetime.datetime.now()
+    # ---------------------------  Data API Query --------------------------
 
-    # website id from user input
-    website_id = user_input["website_id"]
+    # loads run in the background and are shared by the panels refreshing around the same time
+    scheduler_key = f"scheduler:{piwik_domain}:{website_id}:{raw_totals_needed}:{live_distinct}:{total_sections}"
+    if scheduler_key not in st.session_state:
+        st.session_state[scheduler_key] = RefreshScheduler()
+    scheduler = st.session_state[scheduler_key]
+
+    # results are shared with the other viewers of the website for up to max_age secs. owner is the
+    # incremental query holding the rows, it is measured after each of its loads and its shared
+    # results are forgotten when it is evicted
+    def shared_load(query, load, site=website_id, owner=None):
+        key = cache_key(piwik_domain, client_id, site, query)
+        if owner is not None:
+            tenant_cache.attach(tenant, owner, key)
+
+        def accounted_load():
+            data = load()
+            tenant_cache.account(tenant, owner)
+            return data
+
+        def cached_load(max_age):
+            # the viewer's own credentials are checked before any cached data is handed out
+            piwik_tokens.headers()
+            return poll_cache.get(key, accounted_load, max_age)
+        cached_load.keys = [key]
+        return cached_load
+
+    # a part of the latest snapshot ("live" or "totals"), after the viewer's own credentials and their
+    # access to the website are checked
+    def snapshot_load(part, site=website_id):
+        def load(max_age):
+            snapshot_access.check(fetch, query_url, piwik_domain, client_id, site)
+            snapshot = snapshot_store.latest(piwik_domain, site)
+            if snapshot is None:
+                raise ValueError(f"no snapshot of website {site} yet, is its fetch worker running?")
+            return snapshot.values[part]
+        load.keys = []
+        return load
+
+    # only rows newer than the last refresh are requested, merged into the loaded rows
+    if use_snapshots:
+        data_loaders = {
+            "Live Sessions": snapshot_load("live"),
+            "Live Events": snapshot_load("live"),
+            "Aggregated Totals": snapshot_load("totals"),
+        }
+    else:
+        data_loaders = {
+            "Live Sessions": shared_load([live_session_query.query, live_window],
+                                         lambda: live_session_query.refresh(fetch), owner=live_session_query),
+            "Live Events": shared_load([live_event_query.query, live_window, live_distinct],
+                                       lambda: live_event_query.refresh(fetch), owner=live_event_query),
+            "Aggregated Totals": shared_load(["aggregated totals", total_sections],
+                                             lambda: aggregate_totals(fetch, query_url, website_id, total_sections)),
+        }
+        if raw_totals_needed:
+            data_loaders["Session Data"] = shared_load([session_query.query, None],
+                                                       lambda: session_query.refresh(fetch), owner=session_query)
+            data_loaders["Event Data"] = shared_load([event_query.query, None],
+                                                     lambda: event_query.refresh(fetch), owner=event_query)
+
+    # cache keys behind each load name, to tell when a panel shows stale data
+    load_keys = {name: loader.keys for name, loader in data_loaders.items()}
+
+    def request_data(name, refresh_secs):
+        load = functools.partial(data_loaders[name], refresh_secs)
+        return scheduler.request(name, load, refresh_secs)
+
+    def load_data(name, refresh_secs):
+        return request_data(name, refresh_secs).result()
+
+    # starts the loads a panel needs up front so they are in flight together
+    def start_loads(names, refresh_secs):
+        for name in names:
+            request_data(name, refresh_secs)
+
+    def loaded_caption(names, refresh_secs):
+        timings = []
+        for n in names:
+            if n not in scheduler.timings:
+                continue
+            timing = f"{n} {scheduler.timings[n][0]:.2f} secs"
+            # no size while a newer load runs or when it failed, its error is shown by the panel
+            future = scheduler.futures[n]
+            if future.done() and future.exception() is None and isinstance(future.result(), pd.DataFrame):
+                timing += f", {bytes_per_row(future.result()):.0f} bytes/row"
+            timings.append(timing)
+        # the time the data was loaded, not the time of the rerun: a rerun showing the same data sends
+        # the same caption, which the browser already has
+        loaded = [scheduler.timings[n][1] for n in names if n in scheduler.timings]
+        loaded_at = datetime.datetime.fromtimestamp(max(loaded)) if loaded else datetime.datetime.now()
+        now_update = loaded_at.strftime("%Y-%m-%d %H:%M:%S")
+        st.caption(f"✅ Data loaded at {now_update} ({'; '.join(timings)}). "
+                   f"It will automatically refresh in {refresh_secs} secs.")
+
+        # Piwik PRO failing: the last good data is shown, with the time it is from
+        stale = [poll_cache.stale_since(key) for n in names for key in load_keys.get(n, [])]
+        stale = [s for s in stale if s is not None]
+        if stale:
+            since, error = min(stale, key=lambda s: s[0])
+            st.warning(f"⚠️ Stale since {since.strftime('%H:%M:%S')}: Piwik PRO is not answering ({error}). "
+                       f"Showing the last data loaded, retrying in {refresh_secs} secs.")
+
+        # the fetch worker stopped publishing
+        snapshot = snapshot_store.latest(piwik_domain, website_id) if use_snapshots else None
+        if snapshot is not None and (datetime.datetime.now() - snapshot.time).total_seconds() > 3 * refresh_secs:
+            st.warning(f"⚠️ Stale since {snapshot.time.strftime('%H:%M:%S')}: the fetch worker has not "
+                       f"published a snapshot since. Showing the last one.")
+
+    # distinct counts from sketches are shown with their error bound
+    def distinct_help():
+        if event_buckets.error():
+            return f"HyperLogLog estimate, ±{event_buckets.error():.1%} standard error"
+        return None
+
+    def data_error(name, e):
+        print(f"{name} Error: {e}")
+        st.error(f"{name} Error:{e}. Please verify your PiwikPro credentials input.")
+
+    # only the page being looked at goes to the browser, the whole table is exported on demand
+    def paged_table(table, value_column, key):
+        search_col, page_col = st.columns([3, 1])
+        search = search_col.text_input("Search", key=f"{key} search")
+        rows = search_rows(table, search)
+        pages = page_count(rows)
+        page = min(page_col.number_input("Page", min_value=1, step=1, key=f"{key} page"), pages)
+
+        st.dataframe(page_rows(rows, value_column, page - 1), hide_index=True, use_container_width=True)
+        st.caption(f"Page {page} of {pages}, {len(rows)} rows")
+
+        if st.toggle("Export the whole table", key=f"{key} export"):
+            csv_col, parquet_col = st.columns(2)
+            csv_col.download_button("CSV", export_csv(table), f"{key}.csv", "text/csv",
+                                    key=f"{key} csv")
+            parquet_col.download_button("Parquet", export_parquet(table), f"{key}.parquet",
+                                        "application/vnd.apache.parquet", key=f"{key} parquet")
+
+    # the same window at the same time of an earlier day, see piwik_history. the first time, the day is
+    # downloaded in the background and the live numbers are shown without deltas until it is there
+    compare_back = COMPARISONS.get(user_input["compare_with"])
+
+    def compared_window(now):
+        if compare_back is None:
+            return None
+        then = now - compare_back
+
+        def load():
+            piwik_tokens.headers()
+            return history_store.day(fetch, piwik_urls, piwik_domain, website_id, then.date())
+
+        # a past day does not change, it is only asked for again in case it had not settled yet
+        future = scheduler.request(f"Comparison {then.date()}", load, SETTLE_HOURS * 3600)
+        if not future.done():
+            return None
+        if future.exception() is not None:
+            print(f"Comparison Error: {future.exception()}")
+            return None
+        return {**future.result().window(then, live_minutes), "time": then}
+
+    # metric arguments showing the change since the compared day, and its number in the help
+    def compared_metric(compared, name, value, help=None):
+        if compared is None:
+            return {"help": help}
+        note = f"{user_input['compare_with']} at {compared['time']:%H:%M}: {compared[name]}"
+        return {"delta": round(value - compared[name], 2), "help": "  \n".join(filter(None, [help, note]))}
+
+    def incomplete_warning(name, query):
+        if query is not None and query.truncated:
+            st.warning(f"{name} is incomplete: {len(query.truncated)} time slice(s) still hit the API row limit.")
+
+    live_refresh = user_input["live_refresh"]
+    panel_refresh = user_input["panel_refresh"]
+    live_minutes = user_input["live_minutes"]
+    totals_refresh = user_input["totals_refresh"]
+
+    # today's totals from the aggregated query or computed from the raw rows
+    def load_totals(refresh_secs):
+        if aggregated_totals:
+            return load_data("Aggregated Totals", refresh_secs), ["Aggregated Totals"]
+
+        start_loads(["Session Data", "Event Data"], refresh_secs)
+        session_data = load_data("Session Data", refresh_secs)
+        event_data = load_data("Event Data", refresh_secs)
+        return raw_totals(session_data, event_data, total_sections), ["Session Data", "Event Data"]
+
+    # --------------------------- Streamlit panels, each one reruns on its own timer
+    #
+    # a panel waits for its data before it sends anything below its header, then sends every element
+    # once with its value. a placeholder sent first (a 0 metric, an empty slot) would blank what the
+    # browser shows while the panel reruns and send each element twice. elements left unchanged since
+    # the last rerun are sent as a reference to the browser's copy (see .streamlit/config.toml)
+
+    @st.fragment(run_every=panel_refresh["live_traffic"])
+    @recorder.timed("render")
+    def live_traffic_panel():
+        now = datetime.datetime.now()
 
-    query_url = f'https://{piwik_domain}.piwik.pro/api/analytics/v1/query'
-    session_query_url = f'https://{piwik_domain}.piwik.pro/api/analytics/v1/sessions/'
-    event_query_url = f'https://{piwik_domain}.piwik.pro/api/analytics/v1/events/'
+        st.header("Live Traffic and Ecommerce")
 
-    def piwik_query(query, url_query):
-        piwik_response = requests.post(
-            url_query, headers=piwik_headers, data=json.dumps(query))
+        start_loads(["Live Sessions", "Live Events"], panel_refresh["live_traffic"])
 
-        if piwik_response.status_code == 200:
-            piwik_data = pd.DataFrame(piwik_response.json()['data'])
-        else:
-            print(f'session response code is: {piwik_response.status_code}')
-            piwik_data = piwik_response
-        return piwik_data
+        # --------------------------- RAW SESSION DATA -----------------------------
 
-    now = datetime.datetime.now()
-    mins_ago = now - datetime.timedelta(minutes=30)
+        live = None
+        try:
+            load_data("Live Sessions", panel_refresh["live_traffic"])
 
+            # live window read off the per minute buckets
+            live = session_buckets.window(now, live_minutes)
 
-    # --------------------------- Streamlit Data (empty placeholders to be filled later  by on the query api)
+        except Exception as e:
+            data_error("Live Sessions", e)
 
-    update_time = st.sidebar.empty()
+        # ------------------ EVENT DATA ---------------------------------
 
-    tab1, tab2, tab3 = st.tabs(
-        ["Traffic and Ecommerce", "Pageviews", "Searches"])
+        live_events = None
+        try:
+            load_data("Live Events", panel_refresh["live_traffic"])
 
-    with tab1:
+            live_events = event_buckets.window(now, live_minutes)
 
-        st.header("Live Traffic and Ecommerce")
+        except Exception as e:
+            data_error("Live Events", e)
 
+        compared = compared_window(now)
         col1, col2, col3 = st.columns(3)
 
-        st_live_sessions = col1.metric(label="Live Sessions (last 30 mins)",value=0)
-        st_live_orders = col2.metric(label="Live Orders (last 30 mins)",value=0)
-        st_live_revenue = col3.metric(label="Live Revenue (from raw event data)",value=0)
-
-        st_live_minutes = st.empty()
-
-        st_live_source = st.dataframe()
+        if live is not None:
+            col1.metric(f"Live Sessions (last {live_minutes} mins)", live["sessions"],
+                        **compared_metric(compared, "sessions", live["sessions"]))
+            col2.metric(f"Live Orders (last {live_minutes} mins)", live["orders"],
+                        **compared_metric(compared, "orders", live["orders"]))
+        if live_events is not None:
+            col3.metric(f"Live Revenue (last {live_minutes} mins) €,$...", live_events["revenue"],
+                        **compared_metric(compared, "revenue", live_events["revenue"]))
 
-        if user_input["total_sessions"]: 
-            st.header("Today's Total Traffic and Ecommerce")
+        incomplete_warning("Live sessions", live_session_query)
+        incomplete_warning("Live events", live_event_query)
 
-            col4, col5, col6 = st.columns(3)
-
-            st_total_sessions = col4.metric(label="Today's Total Sessions",value=0)
-            st_total_orders = col5.metric(label="Today's Total Orders",value=0)
-            st_total_revenue = col6.metric(label="Total Revenue (from raw event data)",value=0)
+        if live is not None:
+            st.bar_chart(live["minutes"], x='Time')
+            paged_table(live["sources"], "sessions", "live sources")
 
-            st_total_sessions_source = st.dataframe()
+        loaded_caption(["Live Sessions", "Live Events"], panel_refresh["live_traffic"])
 
-    with tab2:
+    @st.fragment(run_every=panel_refresh["live_pageviews"])
+    @recorder.timed("render")
+    def live_pageviews_panel():
+        now = datetime.datetime.now()
 
         st.header("Live Pageviews")
 
-        st_total_live_pageviews = st.metric(label="Total Live Pageviews (last 30 mins)", value=0)
-        st_live_pageviews = st.empty()
-
-        if user_input["total_pageviews"]:
-
-            st.header("Today's Total Pageviews")
-
-            st_total_pageviews = st.metric("Today's Total Pageviews",value=0)
-            st_table_total_pageviews = st.empty()
-    
-    with tab3:
-
-        st.header("Live Searches")
-
-        st_total_live_searches = st.metric(
-            "Total Live Searches (last 30 mins)",value=0)
-        st_live_searches = st.empty()
-
-        if user_input["total_searches"]:
-            st.header("Today's Total Searches")
-            st_total_searches = st.metric("Today's Total Searches", value=0)
-            st_table_total_searches=st.empty()
-
-    st_spinner = st.empty()
-
-    # ---------------------------  Data API Query --------------------------
-
-    # --------------------------- RAW SESSION DATA -----------------------------
-
-    # initialize df_live_minutes here
-    with st.spinner("Data is loading. Event Data may take longer depending on volume 🥵"):
-
-        raw_session_query = {
-            "relative_date": "today",
-            "website_id": website_id,
-            "columns": [
-                {
-                    "column_id": "source"
-                },
-                {
-                    "column_id": "medium"
-                },
-                {
-                    "column_id": "campaign_name"
-                },
-                {
-                    "column_id": "session_total_ecommerce_conversions"
-                },
-
-            ],
-            "filters": {
-                "operator": "and",
-                "conditions": []
-            },
-            "offset": 0,
-            "limit": 100000,
-            "format": "json"
-        }
-
         try:
+            load_data("Live Events", panel_refresh["live_pageviews"])
 
-            session_data = piwik_query(
-                raw_session_query, session_query_url)
-
-            session_query_columns = [
-                'session_id',  'visitor_id', 'timestamp']
-            for i in raw_session_query["columns"]:
-                for v in i.values():
-                    session_query_columns.append(v)
-
-            session_data.columns = session_query_columns
-
-            session_data["timestamp"] = pd.to_datetime(
-                session_data["timestamp"])
-
-            session_data = session_data.sort_values(
-                'timestamp', ascending=False)
-
-
+            live_events = event_buckets.window(now, live_minutes)
 
-            # ------------------- LIVE session data from timeframe (30 mins)
+            st.metric(f"Total Live Pageviews (last {live_minutes} mins)", live_events["pageviews"],
+                      **compared_metric(compared_window(now), "pageviews", live_events["pageviews"],
+                                        distinct_help()))
 
-            # loc function to retrieve last 30 minutes raw sessions
-            df_live = session_data.loc[session_data["timestamp"].between(
-                mins_ago, now)]
-            
+            paged_table(live_events["pageviews_table"], "pageviews", "live pageviews")
 
-            # Total timeframe sessions metric
-            live_sessions = df_live["session_id"].nunique()
-            st_live_sessions.metric(
-                "Live Sessions (last 30 mins)", live_sessions)            
-
-            # Total timeframe Session Order Conversions
-            live_orders = df_live["session_total_ecommerce_conversions"].sum(
-            )
-            st_live_orders.metric("Live Orders (last 30 mins)", live_orders)
-
-
-            df_live_source = df_live.groupby(["source", "medium", "campaign_name"]).agg(
-                {"session_id": "count", "session_total_ecommerce_conversions": "sum"}).sort_values("session_id", ascending=False).reset_index()
-
-            df_live_source.rename(columns={
-                'session_id': 'sessions', 'session_total_ecommerce_conversions': 'orders'}, inplace=True)
-            
-            
-            df_live_source[r"% conversion rate"]=df_live_source["orders"]/df_live_source["sessions"]*100
+        except Exception as e:
+            data_error("Live Events", e)
 
+        loaded_caption(["Live Events"], panel_refresh["live_pageviews"])
 
+    @st.fragment(run_every=panel_refresh["live_searches"])
+    @recorder.timed("render")
+    def live_searches_panel():
+        now = datetime.datetime.now()
 
-            # dataframe to plot sessions per minute
-            df_live_minutes = df_live[['timestamp', 'session_id']]
+        st.header("Live Searches")
 
-            # group the data by minute
-            df_live_minutes = df_live_minutes.groupby(pd.Grouper(
-                key="timestamp", freq="1Min")).agg({"session_id": "count"}).reset_index()
+        try:
+            load_data("Live Events", panel_refresh["live_searches"])
 
-            # format the "Time" column to show HH:MM
-            df_live_minutes['timestamp'] = df_live_minutes["timestamp"].dt.strftime(
-                '%H:%M')
+            live_events = event_buckets.window(now, live_minutes)
 
-            # # rename the "session_id" column to "Sessions"
-            df_live_minutes = df_live_minutes.rename(
-                columns={"timestamp": "Time", "session_id": "Sessions"})
-                
-            st_live_minutes.bar_chart(df_live_minutes, x='Time')
-            st_live_source.dataframe(df_live_source, use_container_width=True)    
+            st.metric(f"Total Live Searches (last {live_minutes} mins)", live_events["searches"],
+                      **compared_metric(compared_window(now), "searches", live_events["searches"],
+                                        distinct_help()))
 
+            paged_table(live_events["searches_table"], "unique_searches", "live searches")
 
-            
-           # ------------------- Get today's total orders, revenue, sessions
+        except Exception as e:
+            data_error("Live Events", e)
 
-            if user_input["total_sessions"]:
-                today_orders = round(
-                    session_data["session_total_ecommerce_conversions"].sum())
-                
-                st_total_orders.metric("Today's Total Orders", today_orders)
+        loaded_caption(["Live Events"], panel_refresh["live_searches"])
 
-                today_sessions = session_data["session_id"].nunique()
-                st_total_sessions.metric("Today's Total Sessions", today_sessions)
+    # ------------------- Get today's total orders, revenue, sessions
 
-                df_total_source = session_data.groupby(["source", "medium", "campaign_name"]).agg(
-                    {"session_id": "count", "session_total_ecommerce_conversions": "sum"}).sort_values("session_id", ascending=False).reset_index()
+    @st.fragment(run_every=panel_refresh["total_traffic"])
+    @recorder.timed("render")
+    def total_traffic_panel():
+        st.header("Today's Total Traffic and Ecommerce")
 
-                df_total_source.rename(columns={
-                    'session_id': 'sessions', 'session_total_ecommerce_conversions': 'orders'}, inplace=True)
-                
-                df_total_source[r"% conversion rate"]=df_total_source["orders"]/df_total_source["sessions"]*100
+        try:
+            totals, names = load_totals(panel_refresh["total_traffic"])
 
-                st_total_sessions_source.dataframe(df_total_source,use_container_width=True)
+            col4, col5, col6 = st.columns(3)
+            col4.metric("Today's Total Sessions", totals["sessions"])
+            col5.metric("Today's Total Orders", totals["orders"])
+            col6.metric("Total Revenue €,$...", totals["revenue"])
+            paged_table(totals["sources"], "sessions", "sources")
 
+            loaded_caption(names, panel_refresh["total_traffic"])
 
         except Exception as e:
-            print(f"Session Data Error: {e}")
-            st.error(f"Session Data Error:{e}. Please verify your PiwikPro credentials input.")
+            data_error("Totals", e)
 
+    @st.fragment(run_every=panel_refresh["total_pageviews"])
+    @recorder.timed("render")
+    def total_pageviews_panel():
+        st.header("Today's Total Pageviews")
 
-        # ------------------ EVENT DATA ---------------------------------
-
-        raw_event_query = {
-                "relative_date": "today",
-                "website_id": website_id,
-                "columns": [
-                    {
-                        "column_id": "event_type"
-                    },
-                    {
-                        "column_id": "event_url"
-                    },
-                    {
-                        "column_id": "search_keyword"
-                    },
-                    {
-                        "column_id": "revenue"
-                    },
-                    {
-                        "column_id": "order_id"
-                    },
-
-                ],
-                "order_by": [
-                    [
-                        4,
-                        "desc"
-                    ]
-                ],
-                "filters": {
-                    "operator": "and",
-                    "conditions": [
-                        {
-                            "operator": "or",
-                            "conditions": [
-                                {
-                                    "column_id": "event_type",
-                                    "condition": {
-                                        "operator": "eq",
-                                        "value": 4  # Search
-                                    }
-                                },
-                                {
-                                    "column_id": "event_type",
-                                    "condition": {
-                                        "operator": "eq",
-                                        "value": 1  # Page View
-                                    }
-                                },
-                                {
-                                    "column_id": "event_type",
-                                    "condition": {
-                                        "operator": "eq",
-                                        "value": 9  # Ecommerce Conversion
-                                    }
-                                }
-                            ]
-                        }
-                    ]
-                },
-                "offset": 0,
-                "limit": 100000,
-                "format": "json",
-                "column_format": "name"
-            }
-        
         try:
+            totals, names = load_totals(panel_refresh["total_pageviews"])
 
-            event_data = piwik_query(raw_event_query, event_query_url)
-
-            event_query_columns = ['session_id',
-                                    'event_id', 'visitor_id', 'timestamp']
-            for i in raw_event_query["columns"]:
-                for v in i.values():
-                    event_query_columns.append(v)
-
-            event_data.columns = event_query_columns
-
-            event_data["timestamp"] = pd.to_datetime(
-                event_data["timestamp"])
-
-            # event_type has a list type column. this splits it into two different columns and drops the original afterwards
-            event_data[['event_type_id', 'event_type_name']
-                        ] = event_data['event_type'].apply(lambda x: pd.Series([x[0], x[1]]))
-
-            event_data.drop(columns=['event_type'], inplace=True)
-
-
-            if user_input["total_sessions"]:
-                # Total Ecommerce Revenue from today
-                total_revenue = round(event_data['revenue'].sum(), 2)
-                st_total_revenue.metric("Total Revenue €,$...", total_revenue)            
-
-            # ------------- live events from 30 minutes ago
-            df_live_events = event_data.loc[event_data["timestamp"].between(
-                mins_ago, now)]
-
-
-
-
-            if user_input["total_pageviews"]:
-                # Total pageviews today
-                df_pageviews = event_data[event_data['event_type_id'] == 1]
-
-                total_pageviews = df_pageviews['visitor_id'].nunique()
-                st_total_pageviews.metric("Today's Total Pageviews", total_pageviews)
+            st.metric("Today's Total Pageviews", totals["pageviews"])
+            paged_table(totals["pageviews_table"], "pageviews", "pageviews")
 
-                # total daily table pageviews
-                df_pageviews = df_pageviews.groupby(
-                    'event_url')['visitor_id'].nunique().sort_values(ascending=False).reset_index()
-                df_pageviews = df_pageviews.rename(
-                    columns={"event_url": "url", "visitor_id": "pageviews"})
-                st_table_total_pageviews.dataframe(df_pageviews,use_container_width=True)
+            loaded_caption(names, panel_refresh["total_pageviews"])
 
+        except Exception as e:
+            data_error("Totals", e)
 
+    @st.fragment(run_every=panel_refresh["total_searches"])
+    @recorder.timed("render")
+    def total_searches_panel():
+        st.header("Today's Total Searches")
 
-            # Total searches today
-            if user_input["total_searches"]:
-
-                df_searches = event_data[event_data['event_type_id'] == 4]
-
-                total_searches = df_searches['visitor_id'].nunique()
-                st_total_searches.metric("Today's Total Searches", total_searches)
-
-                # total daily table searches
-                df_searches = df_searches.groupby(
-                    'search_keyword')['visitor_id'].nunique().sort_values(ascending=False).reset_index()
-                df_searches = df_searches.rename(
-                    columns={"visitor_id": "unique_searches"})
-
-
-                st_table_total_searches.dataframe(df_searches,use_container_width=True)
-
-
-
-
-            # live revenue from 30 minutes ago
-            df_total_live_revenue = round(df_live_events['revenue'].sum(), 2)
-            st_live_revenue.metric(
-            "Live Revenue (last 30 mins) €,$...", df_total_live_revenue)
-
-            # live searches
-            df_live_searches = df_live_events[df_live_events['event_type_id'] == 4].groupby(
-                'search_keyword')['visitor_id'].nunique().sort_values(ascending=False).reset_index()
-
-            # live searches table
-            df_live_searches = df_live_searches.rename(
-                columns={"visitor_id": "unique_searches"})
-
-            # total live searches
-            df_total_live_searches = df_live_searches['unique_searches'].sum()
-            st_total_live_searches.metric(
-            "Total Live Searches (last 30 mins)", df_total_live_searches)
-    
-            st_live_searches.dataframe(df_live_searches, use_container_width=True)
-    
-    
-            # live pageviews table
-            df_live_pageviews = df_live_events[df_live_events['event_type_id'] == 1].groupby(
-                'event_url')['visitor_id'].nunique().sort_values(ascending=False).reset_index()
-
-            df_live_pageviews = df_live_pageviews.rename(
-                columns={"event_url": "url", "visitor_id": "pageviews"})
-
-            # total live pageviews
-            df_total_live_pageviews = df_live_pageviews['pageviews'].sum()
-            st_total_live_pageviews.metric(
-            "Total Live Pageviews (last 30 mins)", df_total_live_pageviews)
+        try:
+            totals, names = load_totals(panel_refresh["total_searches"])
 
-            st_live_pageviews.dataframe(df_live_pageviews, use_container_width=True)
+            st.metric("Today's Total Searches", totals["searches"])
+            paged_table(totals["searches_table"], "unique_searches", "searches")
 
+            loaded_caption(names, panel_refresh["total_searches"])
 
         except Exception as e:
-            print(f"Event Data Error: {e}")
-            st.error(f"Event Data Error:{e}. Please verify your PiwikPro credentials input.")
+            data_error("Totals", e)
+
+    # correctness check of the aggregated totals against the raw data ones
+    @st.fragment(run_every=totals_refresh)
+    @recorder.timed("render")
+    def compare_totals_panel():
+        with st.expander("Today's totals: aggregated query vs raw data"):
+            try:
+                aggregated = load_data("Aggregated Totals", totals_refresh)
+                raw = raw_totals(load_data("Session Data", totals_refresh),
+                                 load_data("Event Data", totals_refresh), total_sections)
+                st.dataframe(compare_totals(aggregated, raw), use_container_width=True)
+            except Exception as e:
+                data_error("Totals", e)
+
+    # --------------------------- Several sites: live window and today's sessions of each one
+
+    overview_window = live_window
+
+    # a site's live rows and today's session totals, with the same shared loads the detailed
+    # panels use. each site is its own background load, so the sites are fetched concurrently
+    def site_overview_load(site):
+        if use_snapshots:
+            window = SnapshotWindow(snapshot_store, piwik_domain, site)
+            totals = snapshot_load("totals", site)
+
+            def load(max_age):
+                return window, window, totals(max_age)
+            load.keys = totals.keys
+            return load
+
+        sessions = incremental_query(piwik_domain, client_id, site, "sessions", overview_window)
+        events = incremental_query(piwik_domain, client_id, site, "events", overview_window, live_distinct)
+        loaders = [
+            shared_load([sessions.query, overview_window], lambda: sessions.refresh(fetch), site, sessions),
+            shared_load([events.query, overview_window, live_distinct], lambda: events.refresh(fetch), site,
+                        events),
+            shared_load(["aggregated totals", ["total_sessions"]],
+                        lambda: aggregate_totals(fetch, query_url, site, ["total_sessions"]), site),
+        ]
+
+        def load(max_age):
+            totals = [loader(max_age) for loader in loaders][-1]
+            return sessions.buckets, events.buckets, totals
+        load.keys = [key for loader in loaders for key in loader.keys]
+        return load
+
+    @st.fragment(run_every=live_refresh)
+    @recorder.timed("render")
+    def sites_overview_panel():
+        now = datetime.datetime.now()
+
+        st.header("All Sites")
+
+        futures = {}
+        for site in website_ids:
+            load = site_overview_load(site)
+            load_keys[f"Site {site}"] = load.keys
+            futures[site] = scheduler.request(f"Site {site}", functools.partial(load, live_refresh), live_refresh)
+
+        rows = []
+        for site, future in futures.items():
+            try:
+                session_buckets, event_buckets, totals = future.result()
+                rows.append(overview_row(site, session_buckets.window(now, live_minutes),
+                                         event_buckets.window(now, live_minutes), totals))
+            except Exception as e:
+                print(f"Site {site} Error: {e}")
+                rows.append({"website_id": site, "error": str(e)})
+
+        df_sites = overview_frame(rows)
 
+        col1, col2, col3 = st.columns(3)
+        col1.metric(f"Live Sessions, all sites (last {live_minutes} mins)", int(df_sites["live sessions"].sum()))
+        col2.metric(f"Live Orders, all sites (last {live_minutes} mins)", int(df_sites["live orders"].sum()))
+        col3.metric(f"Live Revenue, all sites (last {live_minutes} mins)", round(df_sites["live revenue"].sum(), 2))
+
+        st.dataframe(df_sites, hide_index=True, use_container_width=True)
+        loaded_caption([f"Site {site}" for site in website_ids], live_refresh)
 
-    now_update = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    st_spinner.success(
-        f"Data Loaded at {now_update}! It will automatically refresh in 10 minutes.", icon="✅")
-    
-    sleep = 600
+    if len(website_ids) > 1:
+        with sites_overview:
+            sites_overview_panel()
 
-    time.sleep(sleep)
-    print(f"data refreshes in {sleep} secs")
+    tab1, tab2, tab3 = st.tabs(
+        ["Traffic and Ecommerce", "Pageviews", "Searches"])
 
+    with tab1:
+        live_traffic_panel()
+        if user_input["total_sessions"]:
+            total_traffic_panel()
 
-    # automated javascript function to refresh page after the token expires and the while loop ends
-    # 60000 ms = 1 min 
+    with tab2:
+        live_pageviews_panel()
+        if user_input["total_pageviews"]:
+            total_pageviews_panel()
 
-    st_javascript("""window.setTimeout( function() {
-    window.location.reload();
-    }, 60000);""")
+    with tab3:
+        live_searches_panel()
+        if user_input["total_searches"]:
+            total_searches_panel()
+
+    if user_input["totals_source"] == "Compare both" and total_sections:
+        compare_totals_panel()
+
+    # hit rate of the data shared between viewers of this server
+    @st.fragment(run_every=live_refresh)
+    @recorder.timed("render")
+    def cache_stats_panel():
+        with st.expander("Shared data cache"):
+            cols = st.columns(5)
+            for col, (name, value) in zip(cols, poll_cache.stats().items()):
+                col.metric(name.capitalize(), value)
+
+            # memory held by the loaded data of every account, and websites dropped to stay in budget
+            cols = st.columns(5)
+            for col, (name, value) in zip(cols, tenant_cache.stats(tenant).items()):
+                col.metric(name, value)
+
+            # refreshes skipped because the probe found nothing new, and the current probe interval
+            queries = [live_session_query, live_event_query, session_query, event_query]
+            st.dataframe(pd.DataFrame({query.name: query.poll.stats() for query in queries if query is not None}),
+                         use_container_width=True)
+
+    cache_stats_panel()
+
+    # where the refresh time goes, stage by stage (this server process, every viewer)
+    @st.fragment(run_every=live_refresh)
+    def performance_panel():
+        with st.expander("Performance"):
+            summary = recorder.summary()
+            if summary:
+                st.dataframe(pd.DataFrame(summary), hide_index=True, use_container_width=True)
+            else:
+                st.caption("No refresh timed yet.")
+
+            # request latency per endpoint, retries, hedged requests and circuit state
+            requests_stats = http.stats()
+            if requests_stats:
+                st.dataframe(pd.DataFrame(requests_stats), hide_index=True, use_container_width=True)
+
+    with st.sidebar:
+        performance_panel()
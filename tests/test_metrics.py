@@ -0,0 +1,83 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from piwik_aggregate import EVENT_TYPE_PAGEVIEW, EVENT_TYPE_SEARCH, TOTAL_SECTIONS, conversion_rate
+from piwik_api import raw_session_query, raw_event_query, SESSION_BASE_COLUMNS, EVENT_BASE_COLUMNS
+from piwik_fake_server import FakeDay, raw_rows
+from piwik_ingest import query_schema, build_frame
+from piwik_metrics import raw_totals
+
+# raw_totals pinned against the pandas implementation it replaced: mask the events of a type, then
+# one groupby and nunique per table
+
+
+@pytest.fixture(scope="module")
+def frames():
+    day = FakeDay(20000, seed=7, now=datetime.datetime(2024, 5, 1, 18, 30))
+    frames = {}
+    for name, query, base_columns in (("sessions", raw_session_query("1"), SESSION_BASE_COLUMNS),
+                                      ("events", raw_event_query("1"), EVENT_BASE_COLUMNS)):
+        query = dict(query, limit=20000)
+        rows = raw_rows(day, query, sessions=name == "sessions")
+        frames[name] = build_frame(rows, query_schema(base_columns, query))
+    return frames["sessions"], frames["events"]
+
+
+def baseline_totals(session_data, event_data, sections):
+    totals = {}
+
+    if "total_sessions" in sections:
+        totals["orders"] = round(session_data["session_total_ecommerce_conversions"].sum())
+        totals["sessions"] = session_data["session_id"].nunique()
+        df_total_source = session_data.groupby(["source", "medium", "campaign_name"], observed=True).agg(
+            {"session_id": "count", "session_total_ecommerce_conversions": "sum"}).reset_index()
+        totals["sources"] = conversion_rate(df_total_source.rename(columns={
+            'session_id': 'sessions', 'session_total_ecommerce_conversions': 'orders'}))
+        totals["revenue"] = round(event_data['revenue'].sum(), 2)
+
+    if "total_pageviews" in sections:
+        df_pageviews = event_data[event_data['event_type_id'] == EVENT_TYPE_PAGEVIEW]
+        totals["pageviews"] = df_pageviews['visitor_id'].nunique()
+        totals["pageviews_table"] = df_pageviews.groupby('event_url', observed=True)['visitor_id'].nunique(
+            ).reset_index().rename(columns={"event_url": "url", "visitor_id": "pageviews"})
+
+    if "total_searches" in sections:
+        df_searches = event_data[event_data['event_type_id'] == EVENT_TYPE_SEARCH]
+        totals["searches"] = df_searches['visitor_id'].nunique()
+        totals["searches_table"] = df_searches.groupby('search_keyword', observed=True)['visitor_id'].nunique(
+            ).reset_index().rename(columns={"visitor_id": "unique_searches"})
+
+    return totals
+
+
+# tables are compared row for row, in the order of their dimension columns
+def sorted_table(table):
+    dimensions = list(table.select_dtypes(exclude="number").columns)
+    table = table.astype({c: "string" for c in dimensions})
+    return table.sort_values(dimensions).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("sections", [[s] for s in TOTAL_SECTIONS] + [list(TOTAL_SECTIONS)])
+def test_raw_totals_match_baseline(frames, sections):
+    session_data, event_data = frames
+    expected = baseline_totals(session_data, event_data, sections)
+    totals = raw_totals(session_data, event_data, sections)
+
+    assert set(totals) == set(expected)
+    for key, value in expected.items():
+        if isinstance(value, pd.DataFrame):
+            assert len(value) > 0
+            pd.testing.assert_frame_equal(sorted_table(totals[key]), sorted_table(value), check_dtype=False)
+        else:
+            assert totals[key] == value, key
+
+
+def test_revenue_keeps_its_cents(frames):
+    session_data, _ = frames
+    prices = np.random.default_rng(3).integers(100, 20000, 100000) / 100
+    event_data = pd.DataFrame({"revenue": prices.astype("float32")})
+    totals = raw_totals(session_data, event_data, ["total_sessions"])
+    assert totals["revenue"] == round(float(prices.astype("float32").astype("float64").sum()), 2)